@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
-import time
 from modules import cbpi
 from modules.core.controller import KettleController
 from modules.core.props import Property
+from .autotune import RelayAutotuner
+from .clock import MonotonicClock
+from .coordinator import power_coordinator
+from .filters import parse_filters
+from .loop import ControlLoop, celsius
+from .modulation import ModulatingClock, SigmaDelta, TimeProportioning
+from .mpc import PredictiveController, ThermalModel
+from .profiling import register_endpoints
+from .schedule import parse_schedule
+from .setpoint import SetpointRamp
 
 # Property descriptions
 kp_description = "The proportional term, also known as kp, is the action of PID in response to each unit of error. kp dictates the aggressiveness of action. \nThe units of kp are output / process variable (e.g. % / °C)"
@@ -13,15 +22,95 @@ notification_timeout_description = "Notification duration in milliseconds"
 action_description = "Positive action results in the Actor being ON when current value of control variable is BELOW it's set point (e.g. heating). Negative action results in an Actor being OFF when the current value of the control variable is ABOVE it's setpoint (e.g. cooling)."
 maxset_description = "The maximum temperature that the outer loop can set as the target for the inner loop"
 maxoutput_description = "The maximum PWM output %"
+autotune_description = "When on, a relay feedback experiment is run before control starts, switching the output between its limits around the set point. The ultimate gain and period it measures are used to propose PID gains, which are then used for control and shown in a notification. For cascades, the inner loop is tuned first, then the outer loop with the inner loop closed."
+trigger_description = "With Interval, the loop updates once per update interval. With New sample, the loop updates as soon as a sensor delivers a new sample, but no more often than the minimum interval, and the update interval acts as a watchdog in case no new samples arrive."
+overrun_policy_description = "What to do when an update takes longer than the update interval. With Skip, missed updates are dropped and the loop resumes on schedule. With Catch up, missed updates are run back to back until the loop is back on schedule."
+logging_description = "How often loop details are written to the CraftBeerPi log. Log lines are formatted and written in the background."
+echo_description = "Whether loop details are also printed to standard output, at the same rate as they are logged."
+telemetry_file_description = "Whether every loop record is also appended to ./logs/cascadecontrol_kettle_<id>.csv, or to a compact .bin file of doubles (time, loop, target, actual, output, integrator, P, I, D), in batches from the background."
+recorder_description = "Whether every loop record is stored in ./logs/cascadecontrol_kettle_<id>.rec, a compact columnar recording which can be queried by time range without loading the whole file."
+min_interval_description = "The minimum time in seconds between updates when triggered by new samples."
+setpoint_ramp_description = "The maximum rate in degrees per minute at which the outer loop target follows a change in the kettle target, starting from the current temperature. This avoids a large proportional kick and outer loop saturation after a step. Set to 0 to disable."
+setpoint_weight_description = "The fraction of the target used in the error of this term (0 to 1). Weights below 1 soften the response to target changes without changing the response to disturbances, as the integral term still acts on the full error."
+feedforward_description = "Inner loop output (%) added per degree that the target is above the ambient temperature, to compensate for heat loss without waiting for the integral term. Set to 0 to disable."
+ambient_description = "The ambient temperature used for heat loss feed-forward"
+anti_windup_description = "How the integral term is kept from winding up while the output is saturated, in addition to the integrator limits. Conditional integration holds the integrator while the output is saturated and the error would push it further. Back-calculation drives the integrator back by the amount of saturation, at a rate set by the tracking time."
+tracking_time_description = "The time constant in seconds with which back-calculation drives the integrator back while the output is saturated. Shorter times unwind faster. Set to 0 to use the integral time of each loop (or the geometric mean of its integral and derivative times)."
+saturation_feedback_description = "When on, the outer loop integrator is held while the inner loop cannot follow its target because the inner output is at its limit, so the outer loop does not wind up during long heating phases."
+filters_description = "Comma separated filters applied in order to each sensor reading of this loop, e.g. 'outlier:2, median:5, derivative:10'. Available filters are median:SIZE (median of the last SIZE readings), outlier:MAX_STEP[:COUNT] (reject jumps larger than MAX_STEP unless they persist for COUNT readings), lowpass:TIME (first order low-pass, time constant in seconds), kalman:PROCESS:READING (Kalman filter with process variance per second and reading variance), and, for PID loops, derivative:TIME (first order low-pass on the derivative term) and dom (derivative on measurement only). Leave empty for no filtering."
+modulation_description = "How the output is applied to the heater. With Actor power, the output is passed to the actor as its power. With Time proportioning, the heater is switched fully on for the output fraction of each modulation window. With Sigma-delta, the heater is switched on whenever the on time delivered falls behind the output, which gives the most accurate average. Both switch no faster than the minimum on and off times allow."
+modulation_window_description = "The length in seconds of each time proportioning window"
+modulation_on_min_description = "The minimum time in seconds that the heater stays on once switched on by output modulation"
+modulation_off_min_description = "The minimum time in seconds that the heater stays off once switched off by output modulation"
+schedule_description = "Gains scheduled on temperature, as comma separated temperature:kp:ki:kd points, e.g. '65:10:0.5:1, 100:30:0.1:0'. Gains are interpolated linearly between points and held beyond the first and last points, and replace the gains above. The integrator is adjusted as gains change so that the output does not jump. Leave empty to use fixed gains."
+schedule_key_description = "Whether gains are scheduled on the target or on the current temperature of each loop"
+restore_window_description = "Controller state (integrators and hysteresis timing) is saved to ./logs/cascadecontrol_kettle_<id>.state once a minute and when the controller stops. It is restored when a controller starts on the kettle within this many seconds of the last save, so that control resumes without sagging. AdvancedPID and CascadePID take over from each other without a jump in output. Set to 0 to disable."
+element_power_description = "The power in watts of the element (or other load) switched by this controller, for sharing a power budget"
+power_budget_description = "The total power in watts available to all hysteresis controllers sharing a circuit, e.g. 7200 W for 30 A at 240 V. Controllers given a budget share it, are never switched on together beyond it, and the smallest budget given applies. Set to 0 to switch independently."
+power_priority_description = "When the shared power budget does not cover every controller calling for power, those with a higher priority are served first, then those furthest from their target."
+model_step_description = "The length in seconds of each step of the thermal model identified by the controller. Steps must be long enough for the temperatures to change by several sensor resolutions at full output."
+horizon_description = "How far ahead in seconds the controller predicts the temperatures. This should cover the time the mash takes to follow a change in the inner temperature."
+move_penalty_description = "The weight of output changes against temperature errors (° squared per % squared). Higher values give smoother, slower control."
+forgetting_description = "How quickly the identified model forgets old steps (0.9 to 1). Lower values follow changes such as volume faster, but are noisier."
+mpc_ambient_description = "The ambient temperature, towards which the model loses heat"
+sensor_timeout_description = "The time in seconds after which a sensor reading which has not changed is taken as stale, as when a probe drops off the bus and its last value is kept, or a reading freezes. Keep this well above the time the temperature can hold still within the sensor resolution. Staleness is only timed while the output is at its maximum, but a temperature which plateaus at full output, as in a boil, is taken as stale too, so keep this at 0 (disabled) for a kettle which boils."
+sensor_range_description = "Readings outside the sensor minimum and maximum are taken as faulty, e.g. the -127 °C given by a DS18B20 which dropped off the bus. Lower the maximum below 85 °C to also catch the 85 °C a DS18B20 gives after a reset."
+sensor_fallback_description = "What a cascade does while its inner sensor is faulty. With Safe output, the output is held at the safe output (off for hysteresis). With Single loop, the outer temperature is controlled directly, by the inner loop on the outer sensor. The inner temperature is then not measured, so the max inner loop target cannot be kept, and both temperatures may overshoot well beyond their targets. A faulty outer sensor always gives the safe output. A notification is shown, and control resumes without a jump once the sensors recover."
+safe_output_description = "The output (%) applied while the sensors needed for control are faulty"
+autotune_rule_description = "The rule used to propose PID gains from an autotune experiment. Tyreus-Luyben and No overshoot are less aggressive than Ziegler-Nichols."
+
+@cbpi.initalizer(order=9000)
+def init_metrics(cbpi):
+    # Serve the metrics of the running controllers, and the sampling
+    # profiler, from the CraftBeerPi web server
+    register_endpoints(cbpi.app)
+
+
+def create_modulator(controller, modulation, window, on_min, off_min, clock):
+    # The output modulator of a PID controller, or None to set the actor
+    # power directly, counting its switches as actor toggles
+    switch = lambda on: controller.heater_on(100) if on else controller.heater_off()
+    if modulation == "Time proportioning":
+        modulator = TimeProportioning(switch, window, on_min, off_min, clock)
+    elif modulation == "Sigma-delta":
+        modulator = SigmaDelta(switch, Hysteresis(False, on_min, float("inf"), off_min, clock), clock)
+    else:
+        return None
+    controller.profiler.gauge("actor_toggles", lambda: modulator.switches)
+    return modulator
+
+
+def switch_heater(controller, on):
+    # Switch the heater of a hysteresis controller, counting toggles
+    if on:
+        controller.heater_on(100)
+    else:
+        controller.heater_off()
+    if on != controller.last_on:
+        controller.profiler.count("actor_toggles")
+    controller.last_on = on
+    controller.profiler.state("on", on)
+
+
+def hysteresis_checks(p):
+    # Checks shared by the hysteresis controllers
+    return [
+        (p.on_min <= 0.0, "Minimum 'on time' must be positive"),
+        (p.on_max <= 0.0, "Maximum 'on time' must be positive"),
+        (p.on_min >= p.on_max, "Maximum 'on time' must be greater than the minimum 'on time'"),
+        (p.off_min <= 0.0, "Minimum 'off time' must be positive"),
+        (p.power_budget < 0.0, "Shared power budget must not be negative"),
+        (p.power_budget > 0.0 and not 0.0 < p.element_power <= p.power_budget, "Element power must be positive and within the shared power budget")]
+
 
 @cbpi.controller
-class CascadePID(KettleController):
+class CascadePID(ControlLoop):
     a_inner_sensor = Property.Sensor(label="Inner loop sensor")
     b_inner_kp = Property.Number("Inner loop proportional term", True, 5.0, description=kp_description)
     c_inner_ki = Property.Number("Inner loop integral term", True, 0.25, description=ki_description)
     d_inner_kd = Property.Number("Inner loop derivative term", True, 0.0, description=kd_description)
     e_inner_integrator_initial = Property.Number("Inner loop integrator initial value", True, 0.0)
-    if cbpi.get_config_parameter("unit", "C") == "C":
+    if celsius:
         f_maxset = Property.Number("Max inner loop target (°C)", True, 75, description=maxset_description)
     else:
         f_maxset = Property.Number("Max inner loop target (°F)", True, 168, description=maxset_description)
@@ -32,89 +121,288 @@ class CascadePID(KettleController):
     k_outer_integrator_initial = Property.Number("Outer loop integrator initial value", True, 0.0)
     l_update_interval = Property.Number("Update interval (s)", True, 2.5, description=update_interval_description)
     m_notification_timeout = Property.Number("Notification duration (ms)", True, 5000, description=notification_timeout_description)
+    n_autotune = Property.Select(label="Autotune", options=["Off", "On"], description=autotune_description)
+    o_autotune_rule = Property.Select(label="Autotune rule", options=["Tyreus-Luyben", "Ziegler-Nichols", "No overshoot", "PI"], description=autotune_rule_description)
+    p_trigger = Property.Select(label="Loop trigger", options=["Interval", "New sample"], description=trigger_description)
+    q_min_interval = Property.Number("Minimum interval (s)", True, 1.0, description=min_interval_description)
+    r_overrun_policy = Property.Select(label="Overrun policy", options=["Skip", "Catch up"], description=overrun_policy_description)
+    s_logging = Property.Select(label="Loop logging", options=["Every cycle", "Every minute", "Off"], description=logging_description)
+    t_echo = Property.Select(label="Echo loop details to stdout", options=["No", "Yes"], description=echo_description)
+    u_telemetry_file = Property.Select(label="Telemetry file", options=["Off", "CSV", "Binary"], description=telemetry_file_description)
+    v_recorder = Property.Select(label="Loop recorder", options=["On", "Off"], description=recorder_description)
+    w_setpoint_ramp = Property.Number("Setpoint ramp (°/min)", True, 0.0, description=setpoint_ramp_description)
+    x_outer_p_weight = Property.Number("Outer loop setpoint weight for P (b)", True, 1.0, description=setpoint_weight_description)
+    y_outer_d_weight = Property.Number("Outer loop setpoint weight for D (c)", True, 1.0, description=setpoint_weight_description)
+    z_feedforward = Property.Number("Heat loss feed-forward (% / °)", True, 0.0, description=feedforward_description)
+    if celsius:
+        za_ambient = Property.Number("Ambient temperature (°C)", True, 20, description=ambient_description)
+    else:
+        za_ambient = Property.Number("Ambient temperature (°F)", True, 68, description=ambient_description)
+    zb_anti_windup = Property.Select(label="Anti-windup", options=["Clamp", "Conditional integration", "Back-calculation"], description=anti_windup_description)
+    zc_tracking_time = Property.Number("Anti-windup tracking time (s)", True, 0.0, description=tracking_time_description)
+    zd_saturation_feedback = Property.Select(label="Inner loop saturation feedback", options=["Off", "On"], description=saturation_feedback_description)
+    ze_outer_filters = Property.Text(label="Outer loop sensor filters", configurable=True, default_value="", description=filters_description)
+    zf_inner_filters = Property.Text(label="Inner loop sensor filters", configurable=True, default_value="", description=filters_description)
+    zg_modulation = Property.Select(label="Output modulation", options=["Actor power", "Time proportioning", "Sigma-delta"], description=modulation_description)
+    zh_modulation_window = Property.Number("Modulation window (s)", True, 10.0, description=modulation_window_description)
+    zi_modulation_on_min = Property.Number("Modulation minimum time on (s)", True, 2.0, description=modulation_on_min_description)
+    zj_modulation_off_min = Property.Number("Modulation minimum time off (s)", True, 2.0, description=modulation_off_min_description)
+    zk_outer_schedule = Property.Text(label="Outer loop gain schedule", configurable=True, default_value="", description=schedule_description)
+    zl_inner_schedule = Property.Text(label="Inner loop gain schedule", configurable=True, default_value="", description=schedule_description)
+    zm_schedule_key = Property.Select(label="Gain schedule key", options=["Target", "Current value"], description=schedule_key_description)
+    zn_restore_window = Property.Number("State restore window (s)", True, 600, description=restore_window_description)
+    zo_sensor_timeout = Property.Number("Sensor timeout (s)", True, 300, description=sensor_timeout_description)
+    if celsius:
+        zp_sensor_min = Property.Number("Sensor minimum (°C)", True, -20, description=sensor_range_description)
+        zq_sensor_max = Property.Number("Sensor maximum (°C)", True, 110, description=sensor_range_description)
+    else:
+        zp_sensor_min = Property.Number("Sensor minimum (°F)", True, -4, description=sensor_range_description)
+        zq_sensor_max = Property.Number("Sensor maximum (°F)", True, 230, description=sensor_range_description)
+    zr_sensor_fallback = Property.Select(label="Inner sensor fault action", options=["Safe output", "Single loop"], description=sensor_fallback_description)
+    zs_safe_output = Property.Number("Safe output (%)", True, 0, description=safe_output_description)
+
+    label = "PID"
+    loops = {0: ("Outer loop PID", True), 1: ("Inner loop PID", True)}
 
     def stop(self):
         self.actor_power(0.0)
         self.heater_off()
         super(KettleController, self).stop()
 
-    def run(self):
+    def configure(self, clock):
         if not isinstance(self.a_inner_sensor, unicode):
-            self.notify("PID Error", "An inner sensor must be selected", timeout=None, type="danger")
-            raise UserWarning("PID - An inner sensor must be selected")
-
-        # Get inner sensor as an integer
-        inner_sensor = int(self.a_inner_sensor)
-
-        # Ensure all numerical properties are floats
-        inner_kp = float(self.b_inner_kp)
-        inner_ki = float(self.c_inner_ki)
-        inner_kd = float(self.d_inner_kd)
-        inner_integrator_initial = float(self.e_inner_integrator_initial)
-        maxset = float(self.f_maxset)
-        maxoutput = min(float(self.g_maxoutput), 100.0)
-        outer_kp = float(self.h_outer_kp)
-        outer_ki = float(self.i_outer_ki)
-        outer_kd = float(self.j_outer_kd)
-        outer_integrator_initial = float(self.k_outer_integrator_initial)
-        update_interval = float(self.l_update_interval)
-        notification_timeout = float(self.m_notification_timeout)
-
-        # Error check
-        if update_interval <= 0.0:
-            self.notify("PID Error", "Update interval must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Update interval must be positive")
-        elif notification_timeout <= 0.0:
-            cbpi.notify("PID Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Notification timeout must be positive")
-        elif maxoutput < 5.0:
-            cbpi.notify("PID Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Max output must be at least 5%")
-        else:
-            self.heater_on(0.0)
+            self.fail("An inner sensor must be selected", UserWarning)
+        return {
+            "inner_sensor": int(self.a_inner_sensor),
+            "inner_kp": float(self.b_inner_kp),
+            "inner_ki": float(self.c_inner_ki),
+            "inner_kd": float(self.d_inner_kd),
+            "inner_integrator_initial": float(self.e_inner_integrator_initial),
+            "maxset": float(self.f_maxset),
+            "maxoutput": min(float(self.g_maxoutput), 100.0),
+            "outer_kp": float(self.h_outer_kp),
+            "outer_ki": float(self.i_outer_ki),
+            "outer_kd": float(self.j_outer_kd),
+            "outer_integrator_initial": float(self.k_outer_integrator_initial),
+            "update_interval": float(self.l_update_interval),
+            "notification_timeout": float(self.m_notification_timeout),
+            "autotune": self.n_autotune == "On",
+            "autotune_rule": self.o_autotune_rule,
+            "trigger": self.p_trigger,
+            "min_interval": float(self.q_min_interval),
+            "overrun_policy": self.r_overrun_policy,
+            "logging": self.s_logging,
+            "echo": self.t_echo,
+            "telemetry_file": self.u_telemetry_file,
+            "recorder": self.v_recorder,
+            "setpoint_ramp": float(self.w_setpoint_ramp),
+            "outer_p_weight": float(self.x_outer_p_weight),
+            "outer_d_weight": float(self.y_outer_d_weight),
+            "feedforward": float(self.z_feedforward),
+            "ambient": float(self.za_ambient),
+            "anti_windup": self.zb_anti_windup,
+            "tracking_time": float(self.zc_tracking_time),
+            "saturation_feedback": self.zd_saturation_feedback == "On",
+            "outer_filter": parse_filters(self.ze_outer_filters, clock),
+            "inner_filter": parse_filters(self.zf_inner_filters, clock),
+            "modulation": self.zg_modulation,
+            "modulation_window": float(self.zh_modulation_window),
+            "modulation_on_min": float(self.zi_modulation_on_min),
+            "modulation_off_min": float(self.zj_modulation_off_min),
+            "outer_schedule": parse_schedule(self.zk_outer_schedule),
+            "inner_schedule": parse_schedule(self.zl_inner_schedule),
+            "schedule_on_target": self.zm_schedule_key == "Target",
+            "restore_window": float(self.zn_restore_window),
+            "sensor_timeout": float(self.zo_sensor_timeout),
+            "sensor_min": float(self.zp_sensor_min),
+            "sensor_max": float(self.zq_sensor_max),
+            "sensor_fallback": self.zr_sensor_fallback,
+            "safe_output": float(self.zs_safe_output)}
+
+    def checks(self, p):
+        return [
+            (p.maxoutput < 5.0, "Max output must be at least 5%"),
+            (not 0.0 <= p.safe_output <= p.maxoutput, "Safe output must be between 0 and the max output"),
+            (p.setpoint_ramp < 0.0, "Setpoint ramp must not be negative"),
+            (not (0.0 <= p.outer_p_weight <= 1.0 and 0.0 <= p.outer_d_weight <= 1.0), "Setpoint weights must be between 0 and 1"),
+            (p.feedforward < 0.0, "Heat loss feed-forward must not be negative"),
+            (p.tracking_time < 0.0, "Anti-windup tracking time must not be negative"),
+            (p.modulation_window <= 0.0, "Modulation window must be positive"),
+            (p.modulation_on_min < 0.0 or p.modulation_off_min < 0.0, "Modulation minimum on and off times must not be negative"),
+            (bool(p.outer_schedule or p.inner_schedule) and p.autotune, "Autotune cannot be used with a gain schedule")]
+
+    def start(self, p, clock):
+        self.heater_on(0.0)
+        self.pid_clock = clock
 
         # Initialize PID cascade
-        if cbpi.get_config_parameter("unit", "C") == "C":
-            outer_pid = PID(outer_kp, outer_ki, outer_kd, 0.0, maxset, 1.0, outer_integrator_initial)
+        if celsius:
+            self.outer_min, self.outer_error_max = 0.0, 1.0
+        else:
+            self.outer_min, self.outer_error_max = 32, 1.8
+        self.outer_pid = PID(p.outer_kp, p.outer_ki, p.outer_kd, self.outer_min, p.maxset, self.outer_error_max, p.outer_integrator_initial, clock, p.outer_p_weight, p.outer_d_weight, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
+        self.inner_pid = PID(p.inner_kp, p.inner_ki, p.inner_kd, 0.0, p.maxoutput, 1.0, p.inner_integrator_initial, clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.inner_filter.derivative_time, p.inner_filter.derivative_on_measurement)
+        self.inner_saturated = 0
+        self.outer_gains = self.inner_gains = None
+        self.inner_output = 0.0
+        self.handover = None
+        self.single = False
+
+        # Initialize autotuning, which runs on the inner loop first and then
+        # on the outer loop with the inner loop closed
+        if p.autotune:
+            self.autotune = "inner"
+            self.inner_tuner = RelayAutotuner(True, 0.0, p.maxoutput, 0.25 * self.outer_error_max, clock=clock)
         else:
-            outer_pid = PID(outer_kp, outer_ki, outer_kd, 32, maxset, 1.8, outer_integrator_initial)
+            self.autotune = None
 
-        inner_pid = PID(inner_kp, inner_ki, inner_kd, 0.0, maxoutput, 1.0, inner_integrator_initial)
+        # Initialize setpoint ramping
+        self.ramp = SetpointRamp(p.setpoint_ramp, clock)
 
-        while self.is_running():
-            waketime = time.time() + update_interval
+        # Initialize output modulation, which switches the heater instead of
+        # setting its power, and keeps stepping while the loop sleeps
+        self.modulator = create_modulator(self, p.modulation, p.modulation_window, p.modulation_on_min, p.modulation_off_min, clock)
+        return clock if self.modulator is None else ModulatingClock(clock, self.modulator)
 
-            # Get the target temperature
-            outer_target_value = self.get_target_temp()
+    def restore_state(self, p, snapshot):
+        # State from AdvancedPID is handed over on the first update, once the
+        # inner temperature is known
+        if self.autotune is not None:
+            return
+        if snapshot["controller"] == "CascadePID":
+            self.outer_pid.restore(snapshot["loops"]["outer"])
+            self.inner_pid.restore(snapshot["loops"]["inner"])
+        elif snapshot["controller"] == "AdvancedPID":
+            self.handover = snapshot["output"]
 
-            # Calculate inner target value from outer PID
-            outer_current_value = self.get_temp()
-            inner_target_value = round(outer_pid.update(outer_current_value, outer_target_value), 2)
+    def current_state(self):
+        return {"controller": "CascadePID", "output": self.inner_output, "loops": {"outer": self.outer_pid.state(), "inner": self.inner_pid.state()}}
 
-            # Calculate inner output from inner PID
-            inner_current_value = float(cbpi.cache.get("sensors")[inner_sensor].instance.last_value)
-            inner_output = round(inner_pid.update(inner_current_value, inner_target_value), 2)
+    def compute(self, p, outer_current_value, inner_current_value, target):
+        clock = self.pid_clock
 
-            # Update the heater power
-            self.actor_power(inner_output)
+        # Ramp the target temperature towards the kettle target
+        outer_target_value = self.outer_target_value = self.ramp.update(target, outer_current_value)
 
-            # Print loop details
-            cbpi.app.logger.info("[%s] Outer loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, outer_target_value, outer_current_value, inner_target_value, round(outer_pid.integrator, 2)))
-            cbpi.app.logger.info("[%s] Inner loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, inner_target_value, inner_current_value, inner_output, round(inner_pid.integrator, 2)))
-            print("[%s] Outer loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, outer_target_value, outer_current_value, inner_target_value, round(outer_pid.integrator, 2)))
-            print("[%s] Inner loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, inner_target_value, inner_current_value, inner_output, round(inner_pid.integrator, 2)))
+        # Take over from AdvancedPID without a jump in output, holding the
+        # inner loop at its current temperature with the last output. Without
+        # inner integral action, the output is held by a proportional offset
+        # of the inner target instead.
+        if self.handover is not None:
+            inner_target_value = inner_current_value
+            if self.inner_pid.ki == 0.0 and self.inner_pid.kp > 0.0:
+                inner_target_value = min(inner_current_value + self.handover / self.inner_pid.kp, p.maxset)
+            self.outer_pid.track(inner_target_value, outer_current_value, outer_target_value)
+            self.inner_pid.track(self.handover, inner_current_value, inner_target_value)
+            self.handover = None
 
-            # Sleep until update required again
-            if waketime <= time.time() + 0.25:
-                self.notify("PID Error", "Update interval is too short", timeout=notification_timeout, type="warning")
-                cbpi.app.logger.info("PID - Update interval is too short")
-                print("PID - Update interval is too short")
+        # The relays of both experiments switch around the target, which
+        # must therefore be below the max inner target
+        if self.autotune is not None and outer_target_value >= p.maxset:
+            self.fail("Autotune requires a target below the max inner loop target")
+
+        # Calculate inner target value from outer PID, or from the relay
+        # while autotuning
+        if self.autotune == "inner":
+            inner_target_value = outer_target_value
+        elif self.autotune == "outer":
+            inner_target_value = self.outer_tuner.update(outer_current_value, outer_target_value)
+        else:
+            if p.outer_schedule is not None:
+                gains = p.outer_schedule.lookup(outer_target_value if p.schedule_on_target else outer_current_value)
+                if gains is not self.outer_gains:
+                    self.outer_gains = gains
+                    self.outer_pid.set_gains(*gains)
+            inner_target_value = round(self.outer_pid.update(outer_current_value, outer_target_value, saturated=self.inner_saturated), 2)
+        self.inner_target_value = inner_target_value
+
+        # Heat loss feed-forward, in proportion to the difference between
+        # the target and ambient temperatures
+        inner_feedforward = p.feedforward * max(outer_target_value - p.ambient, 0.0)
+
+        # Calculate inner output from inner PID, or from the relay while
+        # autotuning
+        if self.autotune == "inner":
+            inner_output = self.inner_tuner.update(inner_current_value, inner_target_value)
+        else:
+            if p.inner_schedule is not None:
+                gains = p.inner_schedule.lookup(inner_target_value if p.schedule_on_target else inner_current_value)
+                if gains is not self.inner_gains:
+                    self.inner_gains = gains
+                    self.inner_pid.set_gains(*gains)
+            inner_output = round(self.inner_pid.update(inner_current_value, inner_target_value, inner_feedforward), 2)
+        self.inner_output = inner_output
+
+        # Hold the outer integrator while the inner output is at a limit
+        # and the inner loop cannot follow its target
+        if p.saturation_feedback:
+            if inner_output >= p.maxoutput and inner_current_value < inner_target_value:
+                self.inner_saturated = 1
+            elif inner_output <= 0.0 and inner_current_value > inner_target_value:
+                self.inner_saturated = -1
             else:
-                self.sleep(waketime - time.time())
+                self.inner_saturated = 0
+
+        # Switch to the proposed gains once an autotune experiment is done,
+        # starting from the average relay output
+        if self.autotune == "inner" and self.inner_tuner.done:
+            inner_kp, inner_ki, inner_kd = self.inner_tuner.gains(p.autotune_rule)
+            self.inner_pid = PID(inner_kp, inner_ki, inner_kd, 0.0, p.maxoutput, 1.0, self.inner_tuner.bias / inner_ki if inner_ki else 0.0, clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.inner_filter.derivative_time, p.inner_filter.derivative_on_measurement)
+            self.notify("PID Autotune", "Inner loop kp/ki/kd: %.3f/%.4f/%.3f" % (inner_kp, inner_ki, inner_kd), timeout=None, type="success")
+            cbpi.app.logger.info("PID - Inner loop autotune Ku/Pu: %s/%s" % (self.inner_tuner.ultimate_gain, self.inner_tuner.ultimate_period))
+            self.autotune = "outer"
+
+            # The outer relay switches the inner target symmetrically
+            # around the outer target, up to the max inner target. It is
+            # not balanced, as inner targets below the outer temperature
+            # all act alike by turning the heater off.
+            self.outer_tuner = RelayAutotuner(True, min(2.0 * outer_target_value - p.maxset, p.maxset), p.maxset, 0.25 * self.outer_error_max, cycles=2, balance=False, clock=clock)
+        elif self.autotune == "outer" and self.outer_tuner.done:
+            outer_kp, outer_ki, outer_kd = self.outer_tuner.gains(p.autotune_rule)
+            self.outer_pid = PID(outer_kp, outer_ki, outer_kd, self.outer_min, p.maxset, self.outer_error_max, self.outer_tuner.bias / outer_ki if outer_ki else 0.0, clock, p.outer_p_weight, p.outer_d_weight, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
+            self.notify("PID Autotune", "Outer loop kp/ki/kd: %.3f/%.4f/%.3f" % (outer_kp, outer_ki, outer_kd), timeout=None, type="success")
+            cbpi.app.logger.info("PID - Outer loop autotune Ku/Pu: %s/%s" % (self.outer_tuner.ultimate_gain, self.outer_tuner.ultimate_period))
+            self.autotune = None
+
+        return inner_output
+
+    def actuate(self, p, output):
+        # Update the heater power, or its modulation
+        if self.modulator is not None:
+            self.modulator.set(output)
+        else:
+            self.actor_power(output)
+        self.profiler.state("saturated", output >= p.maxoutput or output <= 0.0)
+
+    def record(self, p, timestamp, outer_current_value, inner_current_value, target, inner_output):
+        outer_pid = self.outer_pid
+        inner_pid = self.inner_pid
+        self.telemetry.push(timestamp, 0, self.outer_target_value, outer_current_value, self.inner_target_value, outer_pid.integrator, outer_pid.p_action, outer_pid.i_action, outer_pid.d_action)
+        self.telemetry.push(timestamp, 1, self.inner_target_value, inner_current_value, inner_output, inner_pid.integrator, inner_pid.p_action, inner_pid.i_action, inner_pid.d_action)
+
+    def single_loop(self, p, outer_current_value, target):
+        # Control the outer temperature with the inner PID alone, taking over
+        # from the last output
+        outer_target_value = self.ramp.update(target, outer_current_value)
+        if not self.single:
+            self.inner_pid.track(self.inner_output, outer_current_value, outer_target_value)
+            self.single = True
+        self.inner_output = round(self.inner_pid.update(outer_current_value, outer_target_value), 2)
+        return self.inner_output
+
+    def safe_output(self, p):
+        self.single = False
+        self.inner_output = p.safe_output
+        return p.safe_output
+
+    def recover(self, p, output):
+        # Hand over to the cascade as from AdvancedPID
+        self.single = False
+        self.handover = output
 
 
 @cbpi.controller
-class AdvancedPID(KettleController):
+class AdvancedPID(ControlLoop):
     a_kp = Property.Number("Proportional term", True, 10.0, description=kp_description)
     b_ki = Property.Number("Integral term", True, 2.0, description=ki_description)
     c_kd = Property.Number("Derivative term", True, 1.0, description=kd_description)
@@ -122,70 +410,174 @@ class AdvancedPID(KettleController):
     e_integrator_initial = Property.Number("Integrator initial value", True, 0.0)
     f_update_interval = Property.Number("Update interval (s)", True, 2.5, description=update_interval_description)
     g_notification_timeout = Property.Number("Notification duration (ms)", True, 5000, description=notification_timeout_description)
+    h_autotune = Property.Select(label="Autotune", options=["Off", "On"], description=autotune_description)
+    i_autotune_rule = Property.Select(label="Autotune rule", options=["Tyreus-Luyben", "Ziegler-Nichols", "No overshoot", "PI"], description=autotune_rule_description)
+    j_trigger = Property.Select(label="Loop trigger", options=["Interval", "New sample"], description=trigger_description)
+    k_min_interval = Property.Number("Minimum interval (s)", True, 1.0, description=min_interval_description)
+    l_overrun_policy = Property.Select(label="Overrun policy", options=["Skip", "Catch up"], description=overrun_policy_description)
+    m_logging = Property.Select(label="Loop logging", options=["Every cycle", "Every minute", "Off"], description=logging_description)
+    n_echo = Property.Select(label="Echo loop details to stdout", options=["No", "Yes"], description=echo_description)
+    o_telemetry_file = Property.Select(label="Telemetry file", options=["Off", "CSV", "Binary"], description=telemetry_file_description)
+    p_recorder = Property.Select(label="Loop recorder", options=["On", "Off"], description=recorder_description)
+    q_anti_windup = Property.Select(label="Anti-windup", options=["Clamp", "Conditional integration", "Back-calculation"], description=anti_windup_description)
+    r_tracking_time = Property.Number("Anti-windup tracking time (s)", True, 0.0, description=tracking_time_description)
+    s_filters = Property.Text(label="Sensor filters", configurable=True, default_value="", description=filters_description)
+    t_modulation = Property.Select(label="Output modulation", options=["Actor power", "Time proportioning", "Sigma-delta"], description=modulation_description)
+    u_modulation_window = Property.Number("Modulation window (s)", True, 10.0, description=modulation_window_description)
+    v_modulation_on_min = Property.Number("Modulation minimum time on (s)", True, 2.0, description=modulation_on_min_description)
+    w_modulation_off_min = Property.Number("Modulation minimum time off (s)", True, 2.0, description=modulation_off_min_description)
+    x_schedule = Property.Text(label="Gain schedule", configurable=True, default_value="", description=schedule_description)
+    y_schedule_key = Property.Select(label="Gain schedule key", options=["Target", "Current value"], description=schedule_key_description)
+    z_restore_window = Property.Number("State restore window (s)", True, 600, description=restore_window_description)
+    za_sensor_timeout = Property.Number("Sensor timeout (s)", True, 0, description=sensor_timeout_description)
+    if celsius:
+        zb_sensor_min = Property.Number("Sensor minimum (°C)", True, -20, description=sensor_range_description)
+        zc_sensor_max = Property.Number("Sensor maximum (°C)", True, 110, description=sensor_range_description)
+    else:
+        zb_sensor_min = Property.Number("Sensor minimum (°F)", True, -4, description=sensor_range_description)
+        zc_sensor_max = Property.Number("Sensor maximum (°F)", True, 230, description=sensor_range_description)
+    zd_safe_output = Property.Number("Safe output (%)", True, 0, description=safe_output_description)
+
+    label = "PID"
+    loops = {0: ("PID", True)}
 
     def stop(self):
         self.actor_power(0.0)
         self.heater_off()
         super(KettleController, self).stop()
 
-    def run(self):
-        kp = float(self.a_kp)
-        ki = float(self.b_ki)
-        kd = float(self.c_kd)
-        maxoutput = min(float(self.d_maxoutput), 100.0)
-        integrator_initial = float(self.e_integrator_initial)
-        update_interval = float(self.f_update_interval)
-        notification_timeout = float(self.g_notification_timeout)
-
-        # Error check
-        if update_interval <= 0.0:
-            self.notify("PID Error", "Update interval must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Update interval must be positive")
-        elif notification_timeout <= 0.0:
-            cbpi.notify("PID Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Notification timeout must be positive")
-        elif maxoutput < 5.0:
-            cbpi.notify("PID Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("PID - Max output must be at least 5%")
-        else:
-            self.heater_on(0.0)
+    def configure(self, clock):
+        return {
+            "kp": float(self.a_kp),
+            "ki": float(self.b_ki),
+            "kd": float(self.c_kd),
+            "maxoutput": min(float(self.d_maxoutput), 100.0),
+            "integrator_initial": float(self.e_integrator_initial),
+            "update_interval": float(self.f_update_interval),
+            "notification_timeout": float(self.g_notification_timeout),
+            "autotune": self.h_autotune == "On",
+            "autotune_rule": self.i_autotune_rule,
+            "trigger": self.j_trigger,
+            "min_interval": float(self.k_min_interval),
+            "overrun_policy": self.l_overrun_policy,
+            "logging": self.m_logging,
+            "echo": self.n_echo,
+            "telemetry_file": self.o_telemetry_file,
+            "recorder": self.p_recorder,
+            "anti_windup": self.q_anti_windup,
+            "tracking_time": float(self.r_tracking_time),
+            "outer_filter": parse_filters(self.s_filters, clock),
+            "modulation": self.t_modulation,
+            "modulation_window": float(self.u_modulation_window),
+            "modulation_on_min": float(self.v_modulation_on_min),
+            "modulation_off_min": float(self.w_modulation_off_min),
+            "schedule": parse_schedule(self.x_schedule),
+            "schedule_on_target": self.y_schedule_key == "Target",
+            "restore_window": float(self.z_restore_window),
+            "sensor_timeout": float(self.za_sensor_timeout),
+            "sensor_min": float(self.zb_sensor_min),
+            "sensor_max": float(self.zc_sensor_max),
+            "safe_output": float(self.zd_safe_output)}
+
+    def checks(self, p):
+        return [
+            (p.maxoutput < 5.0, "Max output must be at least 5%"),
+            (not 0.0 <= p.safe_output <= p.maxoutput, "Safe output must be between 0 and the max output"),
+            (p.tracking_time < 0.0, "Anti-windup tracking time must not be negative"),
+            (p.modulation_window <= 0.0, "Modulation window must be positive"),
+            (p.modulation_on_min < 0.0 or p.modulation_off_min < 0.0, "Modulation minimum on and off times must not be negative"),
+            (bool(p.schedule) and p.autotune, "Autotune cannot be used with a gain schedule")]
+
+    def start(self, p, clock):
+        self.heater_on(0.0)
+        self.pid_clock = clock
 
         # Initialize PID
-        SinglePID = PID(kp, ki, kd, 0.0, maxoutput, 1.0, integrator_initial)
+        self.pid = PID(p.kp, p.ki, p.kd, 0.0, p.maxoutput, 1.0, p.integrator_initial, clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
+        self.scheduled_gains = None
+        self.output = 0.0
+        self.handover = None
+
+        # Initialize autotuning
+        if p.autotune:
+            self.tuner = RelayAutotuner(True, 0.0, p.maxoutput, 0.25 if celsius else 0.45, clock=clock)
+        else:
+            self.tuner = None
+
+        # Initialize output modulation, which switches the heater instead of
+        # setting its power, and keeps stepping while the loop sleeps
+        self.modulator = create_modulator(self, p.modulation, p.modulation_window, p.modulation_on_min, p.modulation_off_min, clock)
+        return clock if self.modulator is None else ModulatingClock(clock, self.modulator)
+
+    def restore_state(self, p, snapshot):
+        # State from CascadePID is handed over on the first update
+        if self.tuner is not None:
+            return
+        if snapshot["controller"] == "AdvancedPID":
+            self.pid.restore(snapshot["loops"]["pid"])
+        elif snapshot["controller"] == "CascadePID":
+            self.handover = snapshot["output"]
+
+    def current_state(self):
+        return {"controller": "AdvancedPID", "output": self.output, "loops": {"pid": self.pid.state()}}
+
+    def compute(self, p, current_value, inner_current_value, target_value):
+        # Take over from CascadePID without a jump in output
+        if self.handover is not None:
+            self.pid.track(self.handover, current_value, target_value)
+            self.handover = None
 
-        while self.is_running():
-            waketime = time.time() + update_interval
+        tuner = self.tuner
+        if tuner is not None:
+            output = tuner.update(current_value, target_value)
+        else:
+            if p.schedule is not None:
+                gains = p.schedule.lookup(target_value if p.schedule_on_target else current_value)
+                if gains is not self.scheduled_gains:
+                    self.scheduled_gains = gains
+                    self.pid.set_gains(*gains)
+            output = round(self.pid.update(current_value, target_value), 2)
+        self.output = output
 
-            # Get the target temperature
-            target_value = self.get_target_temp()
+        # Switch to the proposed gains once an autotune experiment is done,
+        # starting from the average relay output
+        if tuner is not None and tuner.done:
+            kp, ki, kd = tuner.gains(p.autotune_rule)
+            self.pid = PID(kp, ki, kd, 0.0, p.maxoutput, 1.0, tuner.bias / ki if ki else 0.0, self.pid_clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
+            self.notify("PID Autotune", "kp/ki/kd: %.3f/%.4f/%.3f" % (kp, ki, kd), timeout=None, type="success")
+            cbpi.app.logger.info("PID - Autotune Ku/Pu: %s/%s" % (tuner.ultimate_gain, tuner.ultimate_period))
+            self.tuner = None
 
-            # Calculate inner target value from outer PID
-            current_value = self.get_temp()
-            output = round(SinglePID.update(current_value, target_value), 2)
+        return output
 
-            # Update the heater power
+    def actuate(self, p, output):
+        # Update the heater power, or its modulation
+        if self.modulator is not None:
+            self.modulator.set(output)
+        else:
             self.actor_power(output)
+        self.profiler.state("saturated", output >= p.maxoutput or output <= 0.0)
 
-            # Log details
-            cbpi.app.logger.info("[%s] PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, target_value, current_value, output, round(SinglePID.integrator, 2)))
-            print("[%s] PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, target_value, current_value, output, round(SinglePID.integrator, 2)))
+    def record(self, p, timestamp, current_value, inner_current_value, target_value, output):
+        pid = self.pid
+        self.telemetry.push(timestamp, 0, target_value, current_value, output, pid.integrator, pid.p_action, pid.i_action, pid.d_action)
+
+    def safe_output(self, p):
+        self.output = p.safe_output
+        return p.safe_output
+
+    def recover(self, p, output):
+        # Take over from the safe output without a jump
+        self.handover = output
 
-            # Sleep until update required again
-            if waketime <= time.time() + 0.25:
-                self.notify("PID Error", "Update interval is too short", timeout=notification_timeout, type="warning")
-                cbpi.app.logger.info("PID - Update interval is too short")
-                print("PID - Update interval is too short")
-            else:
-                self.sleep(waketime - time.time())
 
-                
 @cbpi.controller
-class CascadeHysteresis(KettleController):
+class CascadeHysteresis(ControlLoop):
     aa_kp = Property.Number("Proportional term", True, 10.0, description=kp_description)
     ab_ki = Property.Number("Integral term", True, 2.0, description=ki_description)
     ac_kd = Property.Number("Derivative term", True, 1.0, description=kd_description)
     ad_integrator_initial = Property.Number("Integrator initial value", True, 0.0)
-    if cbpi.get_config_parameter("unit", "C") == "C":
+    if celsius:
         ae_maxset = Property.Number("Max hysteresis target (°C)", True, 75, description=maxset_description)
     else:
         ae_maxset = Property.Number("Max hysteresis target (°F)", True, 168, description=maxset_description)
@@ -196,170 +588,406 @@ class CascadeHysteresis(KettleController):
     be_off_min = Property.Number("Hysteresis Minimum Time Off (s)", True, 90)
     c_update_interval = Property.Number("Update interval (s)", True, 2.5, description=update_interval_description)
     d_notification_timeout = Property.Number("Notification duration (ms)", True, 5000, description=notification_timeout_description)
+    e_trigger = Property.Select(label="Loop trigger", options=["Interval", "New sample"], description=trigger_description)
+    f_min_interval = Property.Number("Minimum interval (s)", True, 1.0, description=min_interval_description)
+    g_overrun_policy = Property.Select(label="Overrun policy", options=["Skip", "Catch up"], description=overrun_policy_description)
+    h_logging = Property.Select(label="Loop logging", options=["Every cycle", "Every minute", "Off"], description=logging_description)
+    i_echo = Property.Select(label="Echo loop details to stdout", options=["No", "Yes"], description=echo_description)
+    j_telemetry_file = Property.Select(label="Telemetry file", options=["Off", "CSV", "Binary"], description=telemetry_file_description)
+    k_recorder = Property.Select(label="Loop recorder", options=["On", "Off"], description=recorder_description)
+    l_anti_windup = Property.Select(label="Anti-windup", options=["Clamp", "Conditional integration", "Back-calculation"], description=anti_windup_description)
+    m_tracking_time = Property.Number("Anti-windup tracking time (s)", True, 0.0, description=tracking_time_description)
+    n_saturation_feedback = Property.Select(label="Inner loop saturation feedback", options=["Off", "On"], description=saturation_feedback_description)
+    o_outer_filters = Property.Text(label="Outer loop sensor filters", configurable=True, default_value="", description=filters_description)
+    p_inner_filters = Property.Text(label="Inner loop sensor filters", configurable=True, default_value="", description=filters_description)
+    q_restore_window = Property.Number("State restore window (s)", True, 600, description=restore_window_description)
+    r_element_power = Property.Number("Element power (W)", True, 3500, description=element_power_description)
+    s_power_budget = Property.Number("Shared power budget (W)", True, 0, description=power_budget_description)
+    t_power_priority = Property.Number("Power priority", True, 0, description=power_priority_description)
+    u_sensor_timeout = Property.Number("Sensor timeout (s)", True, 300, description=sensor_timeout_description)
+    if celsius:
+        v_sensor_min = Property.Number("Sensor minimum (°C)", True, -20, description=sensor_range_description)
+        w_sensor_max = Property.Number("Sensor maximum (°C)", True, 110, description=sensor_range_description)
+    else:
+        v_sensor_min = Property.Number("Sensor minimum (°F)", True, -4, description=sensor_range_description)
+        w_sensor_max = Property.Number("Sensor maximum (°F)", True, 230, description=sensor_range_description)
+    x_sensor_fallback = Property.Select(label="Inner sensor fault action", options=["Safe output", "Single loop"], description=sensor_fallback_description)
+
+    label = "Hysteresis"
+    loops = {0: ("Outer loop PID", True), 1: ("Inner hysteresis", False)}
+    switched = True
 
     def stop(self):
         self.heater_off()
         super(KettleController, self).stop()
 
-    def run(self):
-        # Get inner sensor as an integer
-        inner_sensor = int(self.ba_inner_sensor)
-
-        # Outer PID settings
-        kp = float(self.aa_kp)
-        ki = float(self.ab_ki)
-        kd = float(self.ac_kd)
-        integrator_initial = float(self.ad_integrator_initial)
-        maxset = float(self.ae_maxset)
-
-        # Inner hysteresis settings
-        positive = self.bb_action == "Positive"
-        on_min = float(self.bc_on_min)
-        on_max = float(self.bd_on_max)
-        off_min = float(self.be_off_min)
-
-        # General settings
-        update_interval = float(self.c_update_interval)
-        notification_timeout = float(self.d_notification_timeout)
-
-        # Error check
-        if on_min <= 0.0:
-            self.notify("Hysteresis Error", "Minimum 'on time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Minimum 'on time' must be positive")
-        if on_max <= 0.0:
-            self.notify("Hysteresis Error", "Maximum 'on time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Maximum 'on time' must be positive")    
-        if on_min >= on_max:
-            self.notify("Hysteresis Error", "Maximum 'on time' must be greater than the minimum 'on time'", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Maximum 'on time' must be greater than the minimum 'on time'")
-        if off_min <= 0.0:
-            self.notify("Hysteresis Error", "Minimum 'off time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Minimum 'off time' must be positive")
-        if update_interval <= 0.0:
-            self.notify("Hysteresis Error", "Update interval must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Update interval must be positive")
-        elif notification_timeout <= 0.0:
-            cbpi.notify("Hysteresis Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Notification timeout must be positive")
+    def configure(self, clock):
+        if not isinstance(self.ba_inner_sensor, unicode):
+            self.fail("An inner sensor must be selected", UserWarning)
+        return {
+            "kp": float(self.aa_kp),
+            "ki": float(self.ab_ki),
+            "kd": float(self.ac_kd),
+            "integrator_initial": float(self.ad_integrator_initial),
+            "maxset": float(self.ae_maxset),
+            "inner_sensor": int(self.ba_inner_sensor),
+            "positive": self.bb_action == "Positive",
+            "on_min": float(self.bc_on_min),
+            "on_max": float(self.bd_on_max),
+            "off_min": float(self.be_off_min),
+            "update_interval": float(self.c_update_interval),
+            "notification_timeout": float(self.d_notification_timeout),
+            "trigger": self.e_trigger,
+            "min_interval": float(self.f_min_interval),
+            "overrun_policy": self.g_overrun_policy,
+            "logging": self.h_logging,
+            "echo": self.i_echo,
+            "telemetry_file": self.j_telemetry_file,
+            "recorder": self.k_recorder,
+            "anti_windup": self.l_anti_windup,
+            "tracking_time": float(self.m_tracking_time),
+            "saturation_feedback": self.n_saturation_feedback == "On",
+            "outer_filter": parse_filters(self.o_outer_filters, clock),
+            "inner_filter": parse_filters(self.p_inner_filters, clock),
+            "restore_window": float(self.q_restore_window),
+            "element_power": float(self.r_element_power),
+            "power_budget": float(self.s_power_budget),
+            "power_priority": float(self.t_power_priority),
+            "sensor_timeout": float(self.u_sensor_timeout),
+            "sensor_min": float(self.v_sensor_min),
+            "sensor_max": float(self.w_sensor_max),
+            "sensor_fallback": self.x_sensor_fallback}
+
+    def checks(self, p):
+        return hysteresis_checks(p) + [
+            (p.tracking_time < 0.0, "Anti-windup tracking time must not be negative")]
+
+    def start(self, p, clock):
+        # Initialize outer PID
+        if celsius:
+            self.outer_pid = PID(p.kp, p.ki, p.kd, 0.0, p.maxset, 1.0, p.integrator_initial, clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
         else:
-            # Initialize outer PID
-            if cbpi.get_config_parameter("unit", "C") == "C":
-                outer_pid = PID(kp, ki, kd, 0.0, maxset, 1.0, integrator_initial)
+            self.outer_pid = PID(p.kp, p.ki, p.kd, 32, p.maxset, 1.8, p.integrator_initial, clock, 1.0, 1.0, p.anti_windup, p.tracking_time, p.outer_filter.derivative_time, p.outer_filter.derivative_on_measurement)
+        self.inner_saturated = 0
+        self.resume = False
+
+        # Initialize hysteresis
+        self.inner_hysteresis = Hysteresis(p.positive, p.on_min, p.on_max, p.off_min, clock)
+        self.last_on = False
+
+        # Share a power budget with other hysteresis controllers, if any
+        if p.power_budget > 0.0:
+            power_coordinator.join(self.inner_hysteresis, p.element_power, p.power_budget, p.power_priority)
+        return clock
+
+    def restore_state(self, p, snapshot):
+        if snapshot["controller"] == "CascadeHysteresis":
+            self.outer_pid.restore(snapshot["loops"]["outer"])
+            self.inner_hysteresis.restore(snapshot["loops"]["inner"], snapshot["age"])
+
+    def current_state(self):
+        return {"controller": "CascadeHysteresis", "loops": {"outer": self.outer_pid.state(), "inner": self.inner_hysteresis.state()}}
+
+    def compute(self, p, outer_current_value, inner_current_value, outer_target_value):
+        # Resume after a sensor fault with the inner target at the inner
+        # temperature
+        if self.resume:
+            self.outer_pid.track(inner_current_value, outer_current_value, outer_target_value)
+            self.resume = False
+
+        # Calculate inner target value from outer PID
+        inner_target_value = self.inner_target_value = round(self.outer_pid.update(outer_current_value, outer_target_value, saturated=self.inner_saturated), 2)
+
+        # Update the hysteresis controller, within the shared power budget if
+        # any
+        inner_hysteresis = self.inner_hysteresis
+        if p.power_budget > 0.0:
+            on = power_coordinator.update(inner_hysteresis, inner_current_value, inner_target_value)
+        else:
+            on = inner_hysteresis.update(inner_current_value, inner_target_value)
+
+        # Hold the outer integrator while the hysteresis output is fully on
+        # or off and the inner loop still cannot follow its target. Cooling
+        # raises the inner value by being off.
+        if p.saturation_feedback:
+            if inner_current_value < inner_target_value and inner_hysteresis.on == p.positive:
+                self.inner_saturated = 1
+            elif inner_current_value > inner_target_value and inner_hysteresis.on != p.positive:
+                self.inner_saturated = -1
             else:
-                outer_pid = PID(kp, ki, kd, 32, maxset, 1.8, integrator_initial)
+                self.inner_saturated = 0
 
-            # Initialize hysteresis
-            inner_hysteresis = Hysteresis(positive, on_min, on_max, off_min)
+        return on
 
-            while self.is_running():
-                waketime = time.time() + update_interval
+    def actuate(self, p, on):
+        switch_heater(self, on)
 
-                # Get the target temperature
-                outer_target_value = self.get_target_temp()
+    def record(self, p, timestamp, outer_current_value, inner_current_value, outer_target_value, on):
+        outer_pid = self.outer_pid
+        self.telemetry.push(timestamp, 0, outer_target_value, outer_current_value, self.inner_target_value, outer_pid.integrator, outer_pid.p_action, outer_pid.i_action, outer_pid.d_action)
+        self.telemetry.push(timestamp, 1, self.inner_target_value, inner_current_value, 100.0 if self.inner_hysteresis.on else 0.0)
 
-                # Calculate inner target value from outer PID
-                outer_current_value = self.get_temp()
-                inner_target_value = round(outer_pid.update(outer_current_value, outer_target_value), 2)
-                inner_current_value = float(cbpi.cache.get("sensors")[inner_sensor].instance.last_value)
+    def single_loop(self, p, outer_current_value, target):
+        # Switch on the outer temperature alone, within the shared power
+        # budget if any
+        if p.power_budget > 0.0:
+            return power_coordinator.update(self.inner_hysteresis, outer_current_value, target)
+        return self.inner_hysteresis.update(outer_current_value, target)
+
+    def safe_output(self, p):
+        self.inner_hysteresis.turn_off()
+        return False
+
+    def recover(self, p, on):
+        self.resume = True
+
+    def finish(self, p):
+        # Release any share of the power budget
+        power_coordinator.leave(self.inner_hysteresis)
 
-                # Update the hysteresis controller
-                if inner_hysteresis.update(inner_current_value, inner_target_value):
-                    self.heater_on(100)
-                    cbpi.app.logger.info("[%s] Inner hysteresis actor stays ON" % (waketime))
-                    print("[%s] Innner hysteresis actor stays ON" % (waketime))
-                else:
-                    self.heater_off()
-                    cbpi.app.logger.info("[%s] Inner hysteresis actor stays OFF" % (waketime))
-                    print("[%s] Innner hysteresis actor stays OFF" % (waketime))
-
-                # Print loop details
-                cbpi.app.logger.info("[%s] Outer loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, outer_target_value, outer_current_value, inner_target_value, round(outer_pid.integrator, 2)))
-                print("[%s] Outer loop PID target/actual/output/integrator: %s/%s/%s/%s" % (waketime, outer_target_value, outer_current_value, inner_target_value, round(outer_pid.integrator, 2)))
-                    
-                # Sleep until update required again
-                if waketime <= time.time() + 0.25:
-                    self.notify("Hysteresis Error", "Update interval is too short", timeout=notification_timeout, type="warning")
-                    cbpi.app.logger.info("Hysteresis - Update interval is too short")
-                    print("Hysteresis - Update interval is too short")
-                else:
-                    self.sleep(waketime - time.time())       
 
 @cbpi.controller
-class AdvancedHysteresis(KettleController):
+class AdvancedHysteresis(ControlLoop):
     a_action = Property.Select(label="Hysteresis Action Type", options=["Positive", "Negative"], description=action_description)
     b_on_min = Property.Number("Hysteresis Minimum Time On (s)", True, 45)
     c_on_max = Property.Number("Hysteresis Maximum Time On (s)", True, 1800)
     d_off_min = Property.Number("Hysteresis Minimum Time Off (s)", True, 90)
     e_update_interval = Property.Number("Update interval (s)", True, 2.5, description=update_interval_description)
     f_notification_timeout = Property.Number("Notification duration (ms)", True, 5000, description=notification_timeout_description)
+    g_trigger = Property.Select(label="Loop trigger", options=["Interval", "New sample"], description=trigger_description)
+    h_min_interval = Property.Number("Minimum interval (s)", True, 1.0, description=min_interval_description)
+    i_overrun_policy = Property.Select(label="Overrun policy", options=["Skip", "Catch up"], description=overrun_policy_description)
+    j_logging = Property.Select(label="Loop logging", options=["Every cycle", "Every minute", "Off"], description=logging_description)
+    k_echo = Property.Select(label="Echo loop details to stdout", options=["No", "Yes"], description=echo_description)
+    l_telemetry_file = Property.Select(label="Telemetry file", options=["Off", "CSV", "Binary"], description=telemetry_file_description)
+    m_recorder = Property.Select(label="Loop recorder", options=["On", "Off"], description=recorder_description)
+    n_filters = Property.Text(label="Sensor filters", configurable=True, default_value="", description=filters_description)
+    o_restore_window = Property.Number("State restore window (s)", True, 600, description=restore_window_description)
+    p_element_power = Property.Number("Element power (W)", True, 3500, description=element_power_description)
+    q_power_budget = Property.Number("Shared power budget (W)", True, 0, description=power_budget_description)
+    r_power_priority = Property.Number("Power priority", True, 0, description=power_priority_description)
+    s_sensor_timeout = Property.Number("Sensor timeout (s)", True, 0, description=sensor_timeout_description)
+    if celsius:
+        t_sensor_min = Property.Number("Sensor minimum (°C)", True, -20, description=sensor_range_description)
+        u_sensor_max = Property.Number("Sensor maximum (°C)", True, 110, description=sensor_range_description)
+    else:
+        t_sensor_min = Property.Number("Sensor minimum (°F)", True, -4, description=sensor_range_description)
+        u_sensor_max = Property.Number("Sensor maximum (°F)", True, 230, description=sensor_range_description)
+
+    label = "Hysteresis"
+    loops = {0: ("Hysteresis", False)}
+    switched = True
+
+    def stop(self):
+        self.heater_off()
+        super(KettleController, self).stop()
+
+    def configure(self, clock):
+        return {
+            "positive": self.a_action == "Positive",
+            "on_min": float(self.b_on_min),
+            "on_max": float(self.c_on_max),
+            "off_min": float(self.d_off_min),
+            "update_interval": float(self.e_update_interval),
+            "notification_timeout": float(self.f_notification_timeout),
+            "trigger": self.g_trigger,
+            "min_interval": float(self.h_min_interval),
+            "overrun_policy": self.i_overrun_policy,
+            "logging": self.j_logging,
+            "echo": self.k_echo,
+            "telemetry_file": self.l_telemetry_file,
+            "recorder": self.m_recorder,
+            "outer_filter": parse_filters(self.n_filters, clock),
+            "restore_window": float(self.o_restore_window),
+            "element_power": float(self.p_element_power),
+            "power_budget": float(self.q_power_budget),
+            "power_priority": float(self.r_power_priority),
+            "sensor_timeout": float(self.s_sensor_timeout),
+            "sensor_min": float(self.t_sensor_min),
+            "sensor_max": float(self.u_sensor_max)}
+
+    def checks(self, p):
+        return hysteresis_checks(p)
+
+    def start(self, p, clock):
+        # Initialize hysteresis
+        self.hysteresis_on = Hysteresis(p.positive, p.on_min, p.on_max, p.off_min, clock)
+        self.last_on = False
+
+        # Share a power budget with other hysteresis controllers, if any
+        if p.power_budget > 0.0:
+            power_coordinator.join(self.hysteresis_on, p.element_power, p.power_budget, p.power_priority)
+        return clock
+
+    def restore_state(self, p, snapshot):
+        if snapshot["controller"] == "AdvancedHysteresis":
+            self.hysteresis_on.restore(snapshot["loops"]["hysteresis"], snapshot["age"])
+
+    def current_state(self):
+        return {"controller": "AdvancedHysteresis", "loops": {"hysteresis": self.hysteresis_on.state()}}
+
+    def compute(self, p, current_value, inner_current_value, target_value):
+        # Update the hysteresis controller, within the shared power budget if
+        # any
+        if p.power_budget > 0.0:
+            return power_coordinator.update(self.hysteresis_on, current_value, target_value)
+        return self.hysteresis_on.update(current_value, target_value)
+
+    def actuate(self, p, on):
+        switch_heater(self, on)
+
+    def record(self, p, timestamp, current_value, inner_current_value, target_value, on):
+        self.telemetry.push(timestamp, 0, target_value, current_value, 100.0 if self.hysteresis_on.on else 0.0)
+
+    def safe_output(self, p):
+        self.hysteresis_on.turn_off()
+        return False
+
+    def finish(self, p):
+        # Release any share of the power budget
+        power_coordinator.leave(self.hysteresis_on)
+
+
+@cbpi.controller
+class CascadeMPC(ControlLoop):
+    a_inner_sensor = Property.Sensor(label="Inner loop sensor")
+    if celsius:
+        b_maxset = Property.Number("Max inner temperature (°C)", True, 75, description=maxset_description)
+    else:
+        b_maxset = Property.Number("Max inner temperature (°F)", True, 168, description=maxset_description)
+    c_maxoutput = Property.Number("Max output (%)", True, 100, description=maxoutput_description)
+    d_update_interval = Property.Number("Update interval (s)", True, 2.5, description=update_interval_description)
+    e_notification_timeout = Property.Number("Notification duration (ms)", True, 5000, description=notification_timeout_description)
+    f_model_step = Property.Number("Model step (s)", True, 30, description=model_step_description)
+    g_horizon = Property.Number("Prediction horizon (s)", True, 1800, description=horizon_description)
+    h_move_penalty = Property.Number("Output change penalty", True, 0.01, description=move_penalty_description)
+    i_forgetting = Property.Number("Model forgetting factor", True, 0.999, description=forgetting_description)
+    if celsius:
+        j_ambient = Property.Number("Ambient temperature (°C)", True, 20, description=mpc_ambient_description)
+    else:
+        j_ambient = Property.Number("Ambient temperature (°F)", True, 68, description=mpc_ambient_description)
+    k_outer_filters = Property.Text(label="Outer loop sensor filters", configurable=True, default_value="", description=filters_description)
+    l_inner_filters = Property.Text(label="Inner loop sensor filters", configurable=True, default_value="", description=filters_description)
+    m_overrun_policy = Property.Select(label="Overrun policy", options=["Skip", "Catch up"], description=overrun_policy_description)
+    n_logging = Property.Select(label="Loop logging", options=["Every cycle", "Every minute", "Off"], description=logging_description)
+    o_echo = Property.Select(label="Echo loop details to stdout", options=["No", "Yes"], description=echo_description)
+    p_telemetry_file = Property.Select(label="Telemetry file", options=["Off", "CSV", "Binary"], description=telemetry_file_description)
+    q_recorder = Property.Select(label="Loop recorder", options=["On", "Off"], description=recorder_description)
+    r_sensor_timeout = Property.Number("Sensor timeout (s)", True, 0, description=sensor_timeout_description)
+    if celsius:
+        s_sensor_min = Property.Number("Sensor minimum (°C)", True, -20, description=sensor_range_description)
+        t_sensor_max = Property.Number("Sensor maximum (°C)", True, 110, description=sensor_range_description)
+    else:
+        s_sensor_min = Property.Number("Sensor minimum (°F)", True, -4, description=sensor_range_description)
+        t_sensor_max = Property.Number("Sensor maximum (°F)", True, 230, description=sensor_range_description)
+    u_safe_output = Property.Number("Safe output (%)", True, 0, description=safe_output_description)
+
+    label = "MPC"
+    loops = {0: ("Outer loop MPC", False), 1: ("Inner loop MPC", False)}
 
     def stop(self):
+        self.actor_power(0.0)
         self.heater_off()
         super(KettleController, self).stop()
 
-    def run(self):
-        positive = self.a_action == "Positive"
-        on_min = float(self.b_on_min)
-        on_max = float(self.c_on_max)
-        off_min = float(self.d_off_min)
-        update_interval = float(self.e_update_interval)
-        notification_timeout = float(self.f_notification_timeout)
-
-        # Error check
-        if on_min <= 0.0:
-            self.notify("Hysteresis Error", "Minimum 'on time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Minimum 'on time' must be positive")
-        if on_max <= 0.0:
-            self.notify("Hysteresis Error", "Maximum 'on time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Maximum 'on time' must be positive")    
-        if on_min >= on_max:
-            self.notify("Hysteresis Error", "Maximum 'on time' must be greater than the minimum 'on time'", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Maximum 'on time' must be greater than the minimum 'on time'")
-        if off_min <= 0.0:
-            self.notify("Hysteresis Error", "Minimum 'off time' must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Minimum 'off time' must be positive")
-        if update_interval <= 0.0:
-            self.notify("Hysteresis Error", "Update interval must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Update interval must be positive")
-        elif notification_timeout <= 0.0:
-            cbpi.notify("Hysteresis Error", "Notification timeout must be positive", timeout=None, type="danger")
-            raise ValueError("Hysteresis - Notification timeout must be positive")
+    def configure(self, clock):
+        if not isinstance(self.a_inner_sensor, unicode):
+            self.fail("An inner sensor must be selected", UserWarning)
+        return {
+            "inner_sensor": int(self.a_inner_sensor),
+            "maxset": float(self.b_maxset),
+            "maxoutput": min(float(self.c_maxoutput), 100.0),
+            "update_interval": float(self.d_update_interval),
+            "notification_timeout": float(self.e_notification_timeout),
+            "model_step": float(self.f_model_step),
+            "horizon": float(self.g_horizon),
+            "move_penalty": float(self.h_move_penalty),
+            "forgetting": float(self.i_forgetting),
+            "ambient": float(self.j_ambient),
+            "outer_filter": parse_filters(self.k_outer_filters, clock),
+            "inner_filter": parse_filters(self.l_inner_filters, clock),
+            "overrun_policy": self.m_overrun_policy,
+            "logging": self.n_logging,
+            "echo": self.o_echo,
+            "telemetry_file": self.p_telemetry_file,
+            "recorder": self.q_recorder,
+            "sensor_timeout": float(self.r_sensor_timeout),
+            "sensor_min": float(self.s_sensor_min),
+            "sensor_max": float(self.t_sensor_max),
+            "safe_output": float(self.u_safe_output)}
+
+    def checks(self, p):
+        return [
+            (p.maxoutput < 5.0, "Max output must be at least 5%"),
+            (not 0.0 <= p.safe_output <= p.maxoutput, "Safe output must be between 0 and the max output"),
+            (p.model_step < p.update_interval, "Model step must be at least the update interval"),
+            (not 2.0 * p.model_step <= p.horizon <= 200.0 * p.model_step, "Prediction horizon must be between 2 and 200 model steps"),
+            (p.move_penalty <= 0.0, "Output change penalty must be positive"),
+            (not 0.9 <= p.forgetting <= 1.0, "Model forgetting factor must be between 0.9 and 1")]
+
+    def start(self, p, clock):
+        self.heater_on(0.0)
+        self.mpc_clock = clock
+
+        # Initialize the thermal model, which is identified while the
+        # controller runs, and the predictive controller using it. The
+        # controller is kept on the controller for inspection.
+        self.model = ThermalModel(p.model_step, p.ambient, p.forgetting)
+        self.mpc = PredictiveController(self.model, int(round(p.horizon / p.model_step)), p.maxoutput, p.maxset, p.move_penalty)
+        self.output = 0.0
+        return clock
+
+    def compute(self, p, outer_current_value, inner_current_value, target_value):
+        # Identify the model from the output applied since the last update,
+        # then solve for the output. The heater is turned off outright if the
+        # inner temperature has reached its maximum.
+        self.model.observe(self.mpc_clock.time(), self.output, inner_current_value, outer_current_value)
+        if inner_current_value >= p.maxset:
+            self.output = 0.0
         else:
-            # Initialize hysteresis
-            hysteresis_on = Hysteresis(positive, on_min, on_max, off_min)
-            
-            while self.is_running():
-                waketime = time.time() + update_interval
-                
-                # Get the target temperature
-                current_value = self.get_temp()
-                target_value = self.get_target_temp()
-                
-                if hysteresis_on.update(current_value, target_value):
-                    self.heater_on(100)
-                    cbpi.app.logger.info("[%s] Hysteresis actor stays ON" % (waketime))
-                    print("[%s] Hysteresis actor stays ON" % (waketime))
-                else:
-                    self.heater_off()
-                    cbpi.app.logger.info("[%s] Hysteresis actor stays OFF" % (waketime))
-                    print("[%s] Hysteresis actor stays OFF" % (waketime))
-                
-                # Sleep until update required again
-                if waketime <= time.time() + 0.25:
-                    self.notify("Hysteresis Error", "Update interval is too short", timeout=notification_timeout, type="warning")
-                    cbpi.app.logger.info("Hysteresis - Update interval is too short")
-                    print("Hysteresis - Update interval is too short")
-                else:
-                    self.sleep(waketime - time.time())
+            self.output = round(self.mpc.solve(inner_current_value, outer_current_value, target_value, self.output), 2)
+        return self.output
+
+    def actuate(self, p, output):
+        self.actor_power(output)
+        self.profiler.state("saturated", output >= p.maxoutput or output <= 0.0)
+
+    def record(self, p, timestamp, outer_current_value, inner_current_value, target_value, output):
+        # Record the inner temperature predicted one model step ahead as the
+        # inner target
+        inner_target_value = self.mpc.inner_prediction[0] if self.mpc.inner_prediction else inner_current_value
+        self.telemetry.push(timestamp, 0, target_value, outer_current_value, inner_target_value)
+        self.telemetry.push(timestamp, 1, inner_target_value, inner_current_value, output)
+
+    def recover(self, p, output):
+        # The model cannot be identified over the fault
+        self.model.restart()
+        self.output = output
+
+    def log_statistics(self):
+        super(CascadeMPC, self).log_statistics()
+        cbpi.app.logger.info("MPC - Model inner/outer parameters: %s/%s" % (self.model.inner.parameters, self.model.outer.parameters))
 
 
 class PID(object):
-    def __init__(self, kp, ki, kd, output_min, output_max, integrator_error_max, integrator_initial):
+    def __init__(self, kp, ki, kd, output_min, output_max, integrator_error_max, integrator_initial, clock=None, p_weight=1.0, d_weight=1.0, anti_windup="Clamp", tracking_time=0.0, derivative_time=0.0, derivative_on_measurement=False):
         self.kp = kp
         self.ki = ki
         self.kd = kd
         self.output_min = output_min
         self.output_max = output_max
+
+        # Setpoint weights for the proportional and derivative terms. With
+        # weights below 1, a change in target moves the output less abruptly,
+        # while the integral term still acts on the full error. The
+        # proportional weight applies to the part of a change in target that
+        # the process has not yet reached, so that it leaves no offset for the
+        # integrator to absorb once it has. The derivative error is
+        # d_weight * target - current, so that the derivative keeps damping
+        # the approach to a new target.
+        self.p_weight = p_weight
+        self.d_weight = d_weight
+        self.reached = None
         
         # Set integrator maximum in relation to ki and output range
         # such that the maximum integrator alone could result in no 
@@ -374,8 +1002,41 @@ class PID(object):
         # measure to prevent excessive integrator windup
         self.integrator_error_max = abs(integrator_error_max)
         
-        self.last_time = 0.0
-        self.last_error = 0.0
+        # Further anti-windup, in addition to the limits above. With
+        # "Conditional integration", the integrator is held whenever the
+        # output is saturated and the error would drive it further into
+        # saturation. With "Back-calculation", the integrator is driven back
+        # by the amount of saturation of the last output, with the given
+        # tracking time constant (by default the integral time, or the
+        # geometric mean of the integral and derivative times). "Clamp" uses
+        # the limits above only.
+        self.anti_windup = anti_windup
+        self.tracking_time_setting = tracking_time
+        self.tracking_time = self.default_tracking_time()
+        self.last_saturation = 0.0
+        
+        # Time constant of a first order low-pass filter on the derivative,
+        # which keeps sensor quantization from reaching the output as spikes
+        self.derivative_time = derivative_time
+        self.derivative = 0.0
+
+        # With derivative on measurement, the derivative term is
+        # -kd * d(current)/dt, regardless of the target and its weight
+        self.derivative_on_measurement = derivative_on_measurement
+        
+        # Iteration times are measured with a monotonic clock by default
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        self.last_time = None
+        self.last_p_error = 0.0
+        self.last_d_error = 0.0
+
+        # Output components of the last iteration
+        self.p_action = 0.0
+        self.i_action = 0.0
+        self.d_action = 0.0
 
         # Quietly ensure the initial integrator does not exceed
         # the magnitude of the integrator maximum
@@ -384,22 +1045,102 @@ class PID(object):
         else:
             self.integrator = integrator_initial
 
-    def update(self, current, target):
+    def default_tracking_time(self):
+        if self.tracking_time_setting > 0.0:
+            return self.tracking_time_setting
+        elif self.ki != 0.0 and self.kp != 0.0:
+            if self.kd != 0.0:
+                return ((self.kp / self.ki) * (self.kd / self.kp)) ** 0.5
+            return self.kp / self.ki
+        return 1.0
+
+    def set_gains(self, kp, ki, kd):
+        # Change gains without a bump in the output, by moving the integrator
+        # so that the proportional and integral actions of the last iteration
+        # would have added up to the same output with the new gains
+        action = (self.kp - kp) * self.last_p_error + self.ki * self.integrator
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        if ki == 0.0:
+            self.integrator_max = 0.0
+            self.integrator = 0.0
+        else:
+            self.integrator_max = abs((self.output_max-self.output_min)/ki)
+            self.integrator = max(min(action / ki, self.integrator_max), -self.integrator_max)
+        self.tracking_time = self.default_tracking_time()
+
+    def state(self):
+        # State needed to resume control, for persisting across restarts
+        return {
+            "ki": self.ki,
+            "integrator": self.integrator,
+            "last_p_error": self.last_p_error,
+            "last_d_error": self.last_d_error,
+            "derivative": self.derivative,
+            "reached": self.reached}
+
+    def restore(self, state):
+        # Resume from a saved state, keeping the integral action of the saved
+        # state if ki has changed since, and continuing with a regular
+        # iteration rather than an initialization iteration
+        if self.ki != 0.0:
+            self.integrator = max(min(state["integrator"] * state["ki"] / self.ki, self.integrator_max), -self.integrator_max)
+        self.last_p_error = state["last_p_error"]
+        self.last_d_error = state["last_d_error"]
+        self.derivative = state["derivative"]
+        self.reached = state["reached"]
+        self.last_time = self.clock.time()
+
+    def track(self, output, current, target):
+        # Preload the integrator so that the next update from these values
+        # gives the output, for bumpless transfer from another controller
+        p_target, d_target = self.weighted_targets(current, target)
+        if self.ki != 0.0:
+            self.integrator = max(min((output - self.kp * (p_target - current)) / self.ki, self.integrator_max), -self.integrator_max)
+        self.last_p_error = p_target - current
+        self.last_d_error = self.derivative_error(current, d_target)
+        self.last_time = self.clock.time()
+
+    def derivative_error(self, current, d_target):
+        if self.derivative_on_measurement:
+            return -current
+        return d_target - current
+
+    def weighted_targets(self, current, target):
+        # Track the target reached so far, starting from the first value
+        if self.reached is None:
+            self.reached = current
+        if target >= self.reached:
+            self.reached = min(max(self.reached, current), target)
+        else:
+            self.reached = max(min(self.reached, current), target)
+        return self.reached + self.p_weight * (target - self.reached), self.d_weight * target
+
+    def update(self, current, target, feedforward=0.0, saturated=0):
+        # The feedforward term is added to the output as is, e.g. to
+        # compensate for a known heat loss. Saturated is 1 or -1 when a
+        # downstream loop cannot follow a further increase or decrease of
+        # the output (e.g. an inner loop at its output limit), in which case
+        # the integrator is held as with conditional integration.
+        p_target, d_target = self.weighted_targets(current, target)
+
         # Initialization iteration
-        if self.last_time == 0.0:
-            self.last_time = time.time()
-            current_error = target - current
+        if self.last_time is None:
+            self.last_time = self.clock.time()
             
-            # Update last_error
-            self.last_error = current_error
+            # Update last errors and output components
+            self.last_p_error = p_target - current
+            self.last_d_error = self.derivative_error(current, d_target)
+            self.p_action = self.kp * self.last_p_error
             
             # Return output
-            return max(min(self.kp * current_error, self.output_max), self.output_min)
+            return max(min(self.p_action + feedforward, self.output_max), self.output_min)
 
         # Regular iteration
         else:
             # Calculate duration of iteration
-            current_time = time.time()
+            current_time = self.clock.time()
             iteration_time = current_time - self.last_time
             self.last_time = current_time
             
@@ -409,27 +1150,56 @@ class PID(object):
             # Calculate error for use with integratorwith respect to specified error limits
             integrator_error = max(min(current_error, self.integrator_error_max), -self.integrator_error_max)
             
+            # Drive the integrator back by the saturation of the last output
+            if self.anti_windup == "Back-calculation" and self.ki != 0.0:
+                integrator_error += self.last_saturation / (self.ki * self.tracking_time)
+            
             # Update the integrator with respect to total integrator limits
+            last_integrator = self.integrator
             self.integrator = max(min(self.integrator + (integrator_error * iteration_time), self.integrator_max), -self.integrator_max)
             
-            # Calculate error derivative
-            derivative = (current_error - self.last_error)/iteration_time
+            # Calculate weighted error derivative, or the derivative of the
+            # measurement
+            d_error = self.derivative_error(current, d_target)
+            if iteration_time > 0.0:
+                derivative = (d_error - self.last_d_error)/iteration_time
+                if self.derivative_time > 0.0:
+                    derivative = self.derivative + (derivative - self.derivative) * iteration_time / (self.derivative_time + iteration_time)
+            else:
+                derivative = 0.0
+            self.derivative = derivative
             
             # Calculate output components
-            p_action =  self.kp * current_error
-            i_action = self.ki * self.integrator
-            d_action = self.kd * derivative
+            self.last_p_error = p_target - current
+            self.p_action = self.kp * self.last_p_error
+            self.i_action = self.ki * self.integrator
+            self.d_action = self.kd * derivative
             
-            # Update last_error
-            self.last_error = current_error
+            # Update last derivative error
+            self.last_d_error = d_error
             
-            # Return output
-            return max(min(p_action + i_action + d_action, self.output_max), self.output_min)
+            # Hold the integrator if it would drive the output, or a
+            # downstream loop, further into saturation
+            output = self.p_action + self.i_action + self.d_action + feedforward
+            if self.anti_windup == "Conditional integration" or saturated:
+                if integrator_error > 0.0:
+                    hold = saturated > 0 or (self.anti_windup == "Conditional integration" and output > self.output_max)
+                else:
+                    hold = saturated < 0 or (self.anti_windup == "Conditional integration" and output < self.output_min)
+                if hold:
+                    self.integrator = last_integrator
+                    self.i_action = self.ki * self.integrator
+                    output = self.p_action + self.i_action + self.d_action + feedforward
+            
+            # Return output, keeping its saturation for back-calculation
+            limited = max(min(output, self.output_max), self.output_min)
+            self.last_saturation = limited - output
+            return limited
 
 
 
 class Hysteresis(object):
-    def __init__(self, positive, on_min, on_max, off_min):
+    def __init__(self, positive, on_min, on_max, off_min, clock=None):
         # If positive is true, output will be ON when the control variable is
         # BELOW the lowerbound (i.e. heating if controlling temperature)
         #
@@ -448,21 +1218,56 @@ class Hysteresis(object):
         # excessive cycling of a compressor, etc.
         self.off_min = off_min
         
+        # Times are measured with a monotonic clock by default
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
         # To implement min/max on/off times, keep track of time of last change 
         # in the output
-        self.last_change = time.time()
+        self.last_change = self.clock.time()
         
         # Record intended state
         self.on = False
         
-    def update(self, current, target):
-        interval = time.time() - self.last_change
-        if (self.positive & (current <= target)) | (not(self.positive) & (current >= target)):
+    def state(self):
+        # State needed to resume control, for persisting across restarts
+        return {"on": self.on, "elapsed": self.clock.time() - self.last_change}
+
+    def restore(self, state, age):
+        # Resume from a state saved age seconds ago, so that the minimum off
+        # time carries over a restart. An output which was on has been OFF
+        # since the controller stopped, which is taken as the time of saving.
+        self.on = False
+        if state["on"]:
+            self.last_change = self.clock.time() - age
+        else:
+            self.last_change = self.clock.time() - state["elapsed"] - age
+
+    def turn_off(self):
+        # Turn OFF at once, regardless of the ON time minimum, e.g. on a
+        # sensor fault
+        if self.on:
+            self.on = False
+            self.last_change = self.clock.time()
+
+    def update(self, current, target, permit=True):
+        # If permit is false, e.g. when a shared power budget is used up, the
+        # output is not turned ON, and is turned OFF once the ON time minimum
+        # allows
+        now = self.clock.time()
+        interval = now - self.last_change
+        if (self.positive & (current <= target)) | ((not self.positive) & (current >= target)):
             if self.on:
                 if interval > self.on_max:
                     # Current ON time has exceeded ON time maximum
                     # Turn OFF, and update time of last change
-                    self.last_change = time.time()
+                    self.last_change = now
+                    self.on = False
+                elif not permit and interval >= self.on_min:
+                    # Output is no longer permitted
+                    # Turn OFF, and update time of last change
+                    self.last_change = now
                     self.on = False
                 else:
                     # Leave ON
@@ -471,12 +1276,15 @@ class Hysteresis(object):
                 if interval < self.off_min:
                     # Prevent turning ON due to OFF time mininum
                     self.on = False
+                elif not permit:
+                    # Prevent turning ON as output is not permitted
+                    self.on = False
                 else:
                     # OK to turn ON
                     # Turn ON, and update time of last change
-                    self.last_change = time.time()
+                    self.last_change = now
                     self.on = True
-        elif (self.positive & (current > target)) | (not(self.positive) & (current < target)):
+        elif (self.positive & (current > target)) | ((not self.positive) & (current < target)):
             if self.on:
                 if interval < self.on_min:
                     # Current ON time has NOT exceeded minimum, so leave ON
@@ -484,7 +1292,7 @@ class Hysteresis(object):
                 else:
                     # OK to turn OFF
                     # Turn OFF, and update time of last change
-                    self.last_change = time.time()
+                    self.last_change = now
                     self.on = False
             else:
                 # Leave OFF
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import math
+
+from .clock import MonotonicClock
+
+# Tuning rules in terms of the ultimate gain (ku) and period (pu), giving
+# kp, the integral time and the derivative time
+RULES = {
+    "Ziegler-Nichols": lambda ku, pu: (0.6 * ku, pu / 2.0, pu / 8.0),
+    "Tyreus-Luyben": lambda ku, pu: (ku / 2.2, 2.2 * pu, pu / 6.3),
+    "No overshoot": lambda ku, pu: (0.2 * ku, pu / 2.0, pu / 3.0),
+    "PI": lambda ku, pu: (0.45 * ku, pu / 1.2, 0.0),
+}
+
+
+class RelayAutotuner(object):
+    def __init__(self, positive, output_min, output_max, hysteresis=0.25, cycles=3, balance=True, tolerance=0.1, derivative_limit=0.05, clock=None):
+        # Relay feedback (Åström-Hägglund) experiment. The output is switched
+        # between bias + d and bias - d whenever the process variable crosses
+        # the target by more than the hysteresis, which brings the loop into
+        # a limit cycle at its ultimate period.
+        if output_min >= output_max:
+            raise ValueError("The relay output minimum must be below its maximum")
+        self.positive = positive
+        self.output_min = output_min
+        self.output_max = output_max
+        self.hysteresis = abs(hysteresis)
+
+        # The experiment stops once two cycles in a row agree in period,
+        # amplitude and relay amplitude within the tolerance (relative), or
+        # at most after the given number of cycles in addition to the first,
+        # which is then discarded as a transient
+        self.cycles = cycles
+        self.tolerance = tolerance
+
+        # Proposed derivative gains are limited so that a single step of the
+        # reading within one update moves the output by no more than this
+        # fraction of the output range, so that sensor quantization does not
+        # reach the output as spikes
+        self.derivative_limit = derivative_limit
+
+        # Whether to balance the relay, see complete_cycle
+        self.balance = balance
+
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        # Start with the relay spanning the whole output range
+        self.bias = (output_max + output_min) / 2.0
+        self.d = (output_max - output_min) / 2.0
+
+        self.high = None
+        self.high_time = None
+        self.low_time = None
+        self.periods = []
+        self.amplitudes = []
+        self.relay_amplitudes = []
+        self.peak_high = None
+        self.peak_low = None
+
+        # The smallest rate of change of the reading seen between updates,
+        # i.e. one step of the sensor resolution within one update
+        self.last_value = None
+        self.last_time = None
+        self.step_rate = None
+
+        self.done = False
+        self.ultimate_gain = None
+        self.ultimate_period = None
+
+    def update(self, current, target):
+        now = self.clock.time()
+        error = target - current if self.positive else current - target
+
+        if self.last_value is not None and current != self.last_value and now > self.last_time:
+            rate = abs(current - self.last_value) / (now - self.last_time)
+            self.step_rate = rate if self.step_rate is None else min(self.step_rate, rate)
+        self.last_value = current
+        self.last_time = now
+
+        # Track the extremes of the process variable within the cycle
+        if self.peak_high is None:
+            self.peak_high = self.peak_low = current
+        self.peak_high = max(self.peak_high, current)
+        self.peak_low = min(self.peak_low, current)
+
+        # Switch the relay on crossing the hysteresis band
+        if self.high is None:
+            self.high = error > 0.0
+        elif self.high and error < -self.hysteresis:
+            self.high = False
+            self.low_time = now
+        elif not self.high and error > self.hysteresis:
+            self.high = True
+            if self.high_time is not None and self.low_time is not None:
+                self.complete_cycle(now)
+            self.high_time = now
+
+            # Track the extremes afresh for each cycle, leaving out the
+            # approach to the target before the first
+            self.peak_high = self.peak_low = current
+
+        if self.high:
+            return self.bias + self.d
+        return self.bias - self.d
+
+    def complete_cycle(self, now):
+        time_high = self.low_time - self.high_time
+        time_low = now - self.low_time
+        self.periods.append(now - self.high_time)
+        self.amplitudes.append((self.peak_high - self.peak_low) / 2.0)
+        self.relay_amplitudes.append(self.d)
+
+        if self.converged():
+            cycles = 2
+        elif len(self.periods) > self.cycles:
+            cycles = self.cycles
+        else:
+            cycles = 0
+        if cycles:
+            # Average over the last cycles, and use the describing function
+            # of a relay with hysteresis
+            self.ultimate_period = sum(self.periods[-cycles:]) / cycles
+            amplitude = sum(self.amplitudes[-cycles:]) / cycles
+            d = sum(self.relay_amplitudes[-cycles:]) / cycles
+            self.ultimate_gain = 4.0 * d / (math.pi * math.sqrt(max(amplitude ** 2 - self.hysteresis ** 2, 1e-6)))
+            self.done = True
+            return
+
+        # As heating and cooling rates of a kettle differ greatly, the bias
+        # may be adjusted after each cycle so that as much time is spent high
+        # as low, keeping at least 10% of the output range either side of it.
+        # This requires the output to act linearly across its range.
+        if not self.balance:
+            return
+        span = self.output_max - self.output_min
+        bias = self.bias + self.d * (time_high - time_low) / (time_high + time_low)
+        self.bias = max(min(bias, self.output_max - 0.1 * span), self.output_min + 0.1 * span)
+        self.d = min(self.bias - self.output_min, self.output_max - self.bias)
+
+    def converged(self):
+        # Whether the last two cycles agree within the tolerance
+        if len(self.periods) < 2:
+            return False
+        for values in (self.periods, self.amplitudes, self.relay_amplitudes):
+            if abs(values[-1] - values[-2]) > self.tolerance * max(abs(values[-1]), abs(values[-2])):
+                return False
+        return True
+
+    def gains(self, rule="Tyreus-Luyben"):
+        # Proposed kp, ki and kd in the units used by PID, with kd limited
+        kp, integral_time, derivative_time = RULES[rule](self.ultimate_gain, self.ultimate_period)
+        kd = kp * derivative_time
+        if self.step_rate is not None:
+            kd = min(kd, self.derivative_limit * (self.output_max - self.output_min) / self.step_rate)
+        return kp, kp / integral_time, kd
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .clock import MonotonicClock
+
+
+class BatchPID(object):
+    def __init__(self, kp, ki, kd, output_min, output_max, integrator_error_max, integrator_initial, clock=None):
+        # A vectorized equivalent of PID with the Clamp anti-windup and
+        # without setpoint weights, derivative filtering or feedforward,
+        # which steps many independent loops in a single call. Every parameter may be a scalar or an array, and
+        # they are broadcast against each other to give the number of loops.
+        self.kp, self.ki, self.kd, self.output_min, self.output_max, integrator_error_max, integrator_initial = [
+            np.array(value, dtype=float) for value in np.broadcast_arrays(kp, ki, kd, output_min, output_max, integrator_error_max, integrator_initial)]
+
+        # Set integrator maximum in relation to ki and output range, as in PID
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.integrator_max = np.where(self.ki == 0.0, 0.0, np.abs((self.output_max - self.output_min) / self.ki))
+
+        # Error maximum for the integrator, as in PID
+        self.integrator_error_max = np.abs(integrator_error_max)
+
+        # Iteration times are measured with a monotonic clock by default
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        self.last_time = None
+        self.last_error = np.zeros(self.kp.shape)
+
+        # Quietly ensure the initial integrator does not exceed the
+        # magnitude of the integrator maximum, as in PID
+        self.integrator = np.where(np.abs(integrator_initial) > np.abs(self.integrator_max), self.integrator_max, integrator_initial)
+
+    def __len__(self):
+        return self.kp.size
+
+    def update(self, current, target, iteration_time=None):
+        # Step all loops. The iteration time is measured with the clock
+        # unless given, e.g. when sweeping against a simulated plant.
+        current_error = np.asarray(target, dtype=float) - np.asarray(current, dtype=float)
+
+        # Initialization iteration
+        if self.last_time is None:
+            self.last_time = self.clock.time()
+            self.last_error = current_error
+            return np.maximum(np.minimum(self.kp * current_error, self.output_max), self.output_min)
+
+        # Regular iteration
+        current_time = self.clock.time()
+        if iteration_time is None:
+            iteration_time = current_time - self.last_time
+        self.last_time = current_time
+
+        # Update the integrator with respect to the error and total limits
+        integrator_error = np.maximum(np.minimum(current_error, self.integrator_error_max), -self.integrator_error_max)
+        self.integrator = np.maximum(np.minimum(self.integrator + integrator_error * iteration_time, self.integrator_max), -self.integrator_max)
+
+        # Calculate error derivative
+        if iteration_time > 0.0:
+            derivative = (current_error - self.last_error) / iteration_time
+        else:
+            derivative = 0.0
+
+        output = self.kp * current_error + self.ki * self.integrator + self.kd * derivative
+        self.last_error = current_error
+        return np.maximum(np.minimum(output, self.output_max), self.output_min)
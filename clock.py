@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import time
+
+# CLOCK_MONOTONIC on Linux, which CraftBeerPi runs on
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime():
+    # A monotonic source from clock_gettime(CLOCK_MONOTONIC) through ctypes,
+    # for Python 2, which has no monotonic clock in the standard library.
+    # Returns None where clock_gettime is not available.
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        t = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+
+# Only where neither is available, fall back to the wall clock. The
+# scheduler then re-anchors after a backward step of the clock.
+_monotonic = getattr(time, "monotonic", None) or _clock_gettime() or time.time
+
+
+class MonotonicClock(object):
+    def __init__(self, sleep=time.sleep):
+        # Interval timing uses a monotonic source so that wall-clock jumps
+        # (e.g. NTP corrections) do not distort iteration times. The sleep
+        # function is injectable so that controllers can keep using the
+        # cooperative sleep provided by CraftBeerPi.
+        self._sleep = sleep
+
+    def time(self):
+        return _monotonic()
+
+    def wall(self):
+        # Wall-clock time, only to be used for timestamps in logs and records
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0.0:
+            self._sleep(seconds)
+
+
+class VirtualClock(object):
+    def __init__(self, start=0.0, epoch=None):
+        # A clock which only advances when slept on, allowing control loops
+        # to be replayed faster than real time
+        self.now = float(start)
+        if epoch is None:
+            self.epoch = time.time()
+        else:
+            self.epoch = float(epoch)
+
+    def time(self):
+        return self.now
+
+    def wall(self):
+        return self.epoch + self.now
+
+    def sleep(self, seconds):
+        if seconds > 0.0:
+            self.advance(seconds)
+
+    def advance(self, seconds):
+        self.now += seconds
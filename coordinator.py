@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class Member(object):
+    def __init__(self, hysteresis, power, budget, priority):
+        self.hysteresis = hysteresis
+        self.power = power
+        self.budget = budget
+        self.priority = priority
+        self.current = None
+        self.target = None
+        self.updated = hysteresis.clock.time()
+
+    def stale(self, timeout):
+        return self.hysteresis.clock.time() - self.updated > timeout
+
+    def interval(self):
+        return self.hysteresis.clock.time() - self.hysteresis.last_change
+
+    def locked_on(self):
+        # On, and held on by the minimum on time
+        return self.hysteresis.on and self.interval() < self.hysteresis.on_min
+
+    def wants_on(self):
+        # Calling for output, and allowed to have it by its off and on times
+        if self.current is None:
+            return False
+        h = self.hysteresis
+        if h.positive:
+            calling = self.current <= self.target
+        else:
+            calling = self.current >= self.target
+        if h.on:
+            return calling and self.interval() <= h.on_max
+        return calling and self.interval() >= h.off_min
+
+    def error(self):
+        return abs(self.target - self.current)
+
+
+class PowerCoordinator(object):
+    def __init__(self, stale_timeout=60.0):
+        # Shares a power budget (W), e.g. the rating of a circuit, between the
+        # hysteresis controllers of several kettles. Each update allocates the
+        # budget afresh: first to outputs held on by their minimum on time,
+        # then to outputs calling for power, by priority and then by the size
+        # of their error, taking power from outputs ranked below them which
+        # are on. Outputs are never switched in breach of their
+        # minimum on and off times, or maximum on times, and never switched on
+        # while the outputs which are on leave too little of the budget.
+        # Members which have not updated within stale_timeout, e.g. as their
+        # controller failed, are not granted power, but still count as drawing
+        # it while their output is on.
+        self.stale_timeout = stale_timeout
+        self.members = {}
+        self.lock = threading.Lock()
+
+    def join(self, hysteresis, power, budget, priority=0.0):
+        with self.lock:
+            self.members[id(hysteresis)] = Member(hysteresis, power, budget, priority)
+
+    def leave(self, hysteresis):
+        with self.lock:
+            self.members.pop(id(hysteresis), None)
+
+    def allocate(self):
+        # The members granted power, with the smallest budget of any member
+        # applying to all. An output draws its power until it has actually
+        # switched off, so outputs which are off are only granted power that
+        # no output which is on draws, whether or not that output is
+        # granted power itself. Such an output still takes its share of the
+        # budget if the outputs which are on without being granted power
+        # would leave room for it, so that outputs ranked below it lose
+        # theirs. Outputs which lose their share switch off at their next
+        # update once their minimum on time allows, after which the power
+        # is granted.
+        members = [member for member in self.members.values() if not member.stale(self.stale_timeout)]
+        budget = min(member.budget for member in members)
+        drawn = sum(member.power for member in self.members.values() if member.hysteresis.on)
+        granted = set()
+        used = 0.0
+        for member in members:
+            if member.locked_on():
+                granted.add(member)
+                used += member.power
+        candidates = [member for member in members if member not in granted and member.wants_on()]
+        candidates.sort(key=lambda member: (-member.priority, -member.error()))
+        for member in candidates:
+            if used + member.power > budget:
+                continue
+            if not member.hysteresis.on:
+                if drawn + member.power > budget:
+                    # Reserve the power of an output blocked only by outputs
+                    # which are on, so that those ranked below it lose their
+                    # share and make room for it
+                    releasable = sum(other.power for other in members if other.hysteresis.on and other not in granted)
+                    if drawn - releasable + member.power <= budget:
+                        used += member.power
+                    continue
+                drawn += member.power
+            granted.add(member)
+            used += member.power
+        return granted
+
+    def update(self, hysteresis, current, target):
+        # Update a member's hysteresis, permitting its output to be on only
+        # if it is granted power
+        with self.lock:
+            member = self.members[id(hysteresis)]
+            member.current = current
+            member.target = target
+            member.updated = hysteresis.clock.time()
+            return hysteresis.update(current, target, member in self.allocate())
+
+
+# Shared by all controllers in this process
+power_coordinator = PowerCoordinator()
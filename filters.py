@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+from .clock import MonotonicClock
+
+
+class MedianFilter(object):
+    def __init__(self, size=5):
+        # Median of the last size samples, which removes isolated spikes
+        # while preserving steps, after a delay of half the window
+        self.samples = deque(maxlen=size)
+
+    def update(self, value):
+        self.samples.append(value)
+        ordered = sorted(self.samples)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+class OutlierFilter(object):
+    def __init__(self, max_step, count=3):
+        # Rejects samples further than max_step from the last accepted sample,
+        # repeating the last accepted sample instead. A change which persists
+        # for count samples in a row is accepted as a genuine step.
+        self.max_step = abs(max_step)
+        self.count = count
+        self.value = None
+        self.rejected = 0
+
+    def update(self, value):
+        if self.value is None or abs(value - self.value) <= self.max_step or self.rejected >= self.count:
+            self.value = value
+            self.rejected = 0
+        else:
+            self.rejected += 1
+        return self.value
+
+
+class LowPassFilter(object):
+    def __init__(self, time_constant, clock=None):
+        # First order low-pass filter with the given time constant in seconds
+        self.time_constant = time_constant
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+        self.value = None
+        self.last_time = None
+
+    def update(self, value):
+        now = self.clock.time()
+        if self.value is None:
+            self.value = value
+        else:
+            elapsed = now - self.last_time
+            if elapsed > 0.0:
+                self.value += (value - self.value) * elapsed / (self.time_constant + elapsed)
+        self.last_time = now
+        return self.value
+
+
+class KalmanFilter(object):
+    def __init__(self, process_noise, measurement_noise, clock=None):
+        # Scalar Kalman filter for a slowly wandering temperature. The process
+        # noise is the variance the temperature is expected to gain per second
+        # (°²/s), and the measurement noise is the variance of a reading (°²),
+        # e.g. 0.0003 for the 0.0625 °C quantization of a DS18B20.
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+        self.value = None
+        self.variance = measurement_noise
+        self.last_time = None
+
+    def update(self, value):
+        now = self.clock.time()
+        if self.value is None:
+            self.value = value
+        else:
+            # Predict, then correct with the new reading
+            self.variance += self.process_noise * (now - self.last_time)
+            gain = self.variance / (self.variance + self.measurement_noise)
+            self.value += gain * (value - self.value)
+            self.variance *= 1.0 - gain
+        self.last_time = now
+        return self.value
+
+
+class FilterChain(object):
+    def __init__(self, filters=(), derivative_time=0.0, derivative_on_measurement=False):
+        # Sensor filters applied in order to each reading before it reaches
+        # a loop, along with the derivative options of the loop's PID
+        self.filters = list(filters)
+        self.derivative_time = derivative_time
+        self.derivative_on_measurement = derivative_on_measurement
+
+    def update(self, value):
+        for f in self.filters:
+            value = f.update(value)
+        return value
+
+
+def parse_filters(spec, clock=None):
+    # Parse a comma separated filter specification such as
+    # "outlier:2, median:5, derivative:10, dom" into a FilterChain. Each
+    # filter is a name followed by its parameters, separated by colons:
+    #
+    #   median:SIZE              median of the last SIZE readings
+    #   outlier:MAX_STEP[:COUNT] reject jumps larger than MAX_STEP
+    #   lowpass:TIME             first order low-pass, time constant in s
+    #   kalman:PROCESS:READING   scalar Kalman filter, noise variances
+    #   derivative:TIME          first order low-pass on the PID derivative
+    #   dom                      PID derivative on measurement only
+    chain = FilterChain()
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name = item.split(":")[0].strip().lower()
+        try:
+            args = [float(arg) for arg in item.split(":")[1:]]
+        except ValueError:
+            raise ValueError("Invalid filter parameters: %s" % item)
+        if name == "median" and len(args) == 1 and args[0] >= 1:
+            chain.filters.append(MedianFilter(int(args[0])))
+        elif name == "outlier" and len(args) in (1, 2) and args[0] > 0.0:
+            chain.filters.append(OutlierFilter(args[0], int(args[1]) if len(args) == 2 else 3))
+        elif name == "lowpass" and len(args) == 1 and args[0] >= 0.0:
+            chain.filters.append(LowPassFilter(args[0], clock))
+        elif name == "kalman" and len(args) == 2 and args[0] > 0.0 and args[1] > 0.0:
+            chain.filters.append(KalmanFilter(args[0], args[1], clock))
+        elif name == "derivative" and len(args) == 1 and args[0] >= 0.0:
+            chain.derivative_time = args[0]
+        elif name == "dom" and not args:
+            chain.derivative_on_measurement = True
+        else:
+            raise ValueError("Invalid filter: %s" % item)
+    return chain
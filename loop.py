@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+from modules import cbpi
+from modules.core.controller import KettleController
+from modules.core.props import Property
+
+from .clock import MonotonicClock
+from .profiling import LoopProfiler, profilers
+from .recorder import Recorder, recorder_path
+from .scheduler import FixedRateScheduler
+from .sensors import SensorMonitor
+from .state import StateStore, state_path
+from .telemetry import LOG_PERIODS, TelemetryBuffer, TelemetryWriter, telemetry_path
+from .trigger import SampleTrigger
+
+# Whether temperatures are in °C, read once as it also sets property labels
+celsius = cbpi.get_config_parameter("unit", "C") == "C"
+
+# Parameters every controller has, with the defaults used by controllers
+# which do not set them
+DEFAULT_PARAMETERS = {
+    "inner_sensor": None,
+    "outer_filter": None,
+    "inner_filter": None,
+    "trigger": "Interval",
+    "min_interval": 0.0,
+    "restore_window": 0.0,
+    "sensor_timeout": 0.0,
+    "sensor_min": float("-inf"),
+    "sensor_max": float("inf"),
+    "sensor_fallback": "Safe output",
+    "safe_output": 0.0,
+}
+
+_parameter_types = {}
+
+
+def property_default(prop):
+    # The value CraftBeerPi shows for a property which has not been set
+    if isinstance(prop, Property.Select):
+        return prop.options[0]
+    return prop.default_value
+
+
+def property_valid(prop, value):
+    # Whether a property value can be used as is
+    if isinstance(prop, Property.Number):
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+    if isinstance(prop, Property.Select):
+        return value in prop.options
+    return value is not None
+
+
+def freeze(values):
+    # An immutable parameter object with the given values as attributes,
+    # sharing one namedtuple type between controllers of the same type
+    names = tuple(sorted(values))
+    if names not in _parameter_types:
+        _parameter_types[names] = namedtuple("Parameters", names)
+    return _parameter_types[names](**values)
+
+
+class ControlLoop(KettleController):
+    # Loop engine shared by the controllers. On start, a controller's
+    # properties are converted and validated once into an immutable parameter
+    # object, and its kettle and sensors are looked up once. Each update then
+    # runs the same pipeline: read the filtered sensor values and the target,
+    # compute an output, actuate it, and record it, with scheduling, state
+    # saving, telemetry and profiling taken care of here. Controllers plug in
+    # the steps below.
+
+    # Prefix of notifications, log lines and errors
+    label = "PID"
+
+    # Telemetry loop labels, as (name, is_pid) by loop number
+    loops = {0: ("PID", True)}
+
+    # Whether the output switches the heater on or off, rather than setting
+    # its power
+    switched = False
+
+    # Clock used for loop timing, None to use a monotonic clock
+    clock = None
+
+    # The sensor fault being handled ("outer" or "inner"), or None
+    fault = None
+
+    def configure(self, clock):
+        # The controller's parameters by name, converted from its properties.
+        # Raise ValueError for properties which cannot be parsed.
+        raise NotImplementedError
+
+    def checks(self, p):
+        # (failed, message) pairs of further checks, in order of precedence
+        return []
+
+    def start(self, p, clock):
+        # Initialize, returning the clock to schedule updates with
+        return clock
+
+    def compute(self, p, outer, inner, target):
+        # The output for the filtered sensor values and target
+        raise NotImplementedError
+
+    def actuate(self, p, output):
+        raise NotImplementedError
+
+    def record(self, p, timestamp, outer, inner, target, output):
+        # Push the loop details to the telemetry buffer
+        raise NotImplementedError
+
+    def full_output(self, p, output):
+        # Whether the output is at its maximum
+        if self.switched:
+            return output
+        return output >= p.maxoutput
+
+    def single_loop(self, p, outer, target):
+        # The output from the outer sensor alone while the inner sensor is
+        # faulty, or None if the controller cannot do without it
+        return None
+
+    def safe_output(self, p):
+        # The output while the sensors needed for control are faulty
+        return p.safe_output
+
+    def recover(self, p, output):
+        # Resume normal control after a sensor fault, with the output last
+        # applied
+        pass
+
+    def restore_state(self, p, snapshot):
+        # Resume from a recent state snapshot of this kettle
+        pass
+
+    def current_state(self):
+        # A state snapshot to save, for a restart or a handover
+        return None
+
+    def finish(self, p):
+        pass
+
+    def log_statistics(self):
+        cbpi.app.logger.info("%s - Scheduler statistics: %s" % (self.label, self.scheduler.stats()))
+
+    def fail(self, message, error=ValueError):
+        self.notify("%s Error" % self.label, message, timeout=None, type="danger")
+        raise error("%s - %s" % (self.label, message))
+
+    def handle_fault(self, p, fault, sensor, output):
+        # Notify a sensor fault, or the recovery from one
+        profiler = self.profiler
+        if fault is None:
+            self.notify("%s Sensor" % self.label, "Sensors recovered, resuming control", timeout=p.notification_timeout, type="success")
+            cbpi.app.logger.info("%s - Sensors recovered, resuming control" % self.label)
+            self.recover(p, output)
+        else:
+            if fault == "inner" and p.sensor_fallback == "Single loop":
+                action = "switching to single loop control on the outer sensor"
+            else:
+                action = "switching to the safe output"
+            message = "%s sensor %s, %s" % (fault.capitalize(), sensor.fault, action)
+            self.notify("%s Error" % self.label, message, timeout=None, type="danger")
+            profiler.count("sensor_faults")
+            cbpi.app.logger.warning("%s - %s" % (self.label, message))
+        profiler.state("sensor_fault", fault is not None)
+        self.fault = fault
+
+    def record_fault(self, timestamp, outer, target, output):
+        # Push the outer loop details while a sensor is faulty, with a
+        # switched output as 0 or 100 %
+        if self.switched:
+            output = 100.0 if output else 0.0
+        self.telemetry.push(timestamp, 0, target, float("nan") if outer is None else outer, output)
+
+    def resolve_properties(self):
+        # Fall back to the default of each property which is unset, as for a
+        # kettle configured before the property was added, or of a cleared
+        # text. Any other value which cannot be used, as for a number which
+        # does not parse or a select option which no longer exists, is an
+        # error rather than being silently replaced.
+        cls = type(self)
+        for name in dir(cls):
+            prop = getattr(cls, name)
+            if not isinstance(prop, (Property.Number, Property.Select, Property.Text)):
+                continue
+            value = getattr(self, name)
+            if value is prop or (value is None and isinstance(prop, Property.Text)):
+                cbpi.app.logger.info("%s - %s is not set, using the default %s" % (self.label, prop.label, property_default(prop)))
+                setattr(self, name, property_default(prop))
+            elif not property_valid(prop, value):
+                self.fail("Invalid %s: %r" % (prop.label, value))
+
+    def compile(self, clock):
+        # Convert and validate the properties into an immutable parameter
+        # object, notifying and raising on the first error
+        self.resolve_properties()
+        values = dict(DEFAULT_PARAMETERS)
+        try:
+            values.update(self.configure(clock))
+        except (TypeError, ValueError, KeyError) as e:
+            self.fail(str(e))
+        p = freeze(values)
+        checks = [
+            (p.update_interval <= 0.0, "Update interval must be positive"),
+            (p.notification_timeout <= 0.0, "Notification timeout must be positive"),
+            (p.min_interval < 0.0, "Minimum interval must not be negative"),
+            (p.restore_window < 0.0, "State restore window must not be negative"),
+            (p.sensor_timeout < 0.0, "Sensor timeout must not be negative"),
+            (p.sensor_min >= p.sensor_max, "Sensor minimum must be below the sensor maximum")]
+        for failed, message in checks + self.checks(p):
+            if failed:
+                self.fail(message)
+        return p
+
+    def run(self):
+        # Use a monotonic clock with cooperative sleeping unless another
+        # clock (e.g. a VirtualClock for simulation) has been injected
+        clock = self.clock or MonotonicClock(self.sleep)
+        p = self.compile(clock)
+
+        # Look up the kettle and sensors once, rather than on every update,
+        # and check every sensor reading for faults
+        kettle = cbpi.cache.get("kettle")[self.kettle_id]
+        sensors = cbpi.cache.get("sensors")
+        outer_sensor = SensorMonitor(sensors[int(kettle.sensor)].instance, p.sensor_min, p.sensor_max, p.sensor_timeout, clock)
+        if p.inner_sensor is not None:
+            inner_sensor = SensorMonitor(sensors[p.inner_sensor].instance, p.sensor_min, p.sensor_max, p.sensor_timeout, clock)
+        else:
+            inner_sensor = None
+        outer_filter = p.outer_filter
+        inner_filter = p.inner_filter
+        output = None
+        driving = False
+
+        # Initialize profiling, keeping the profiler on the controller, and
+        # serve its metrics from the metrics endpoint once scheduling is set up
+        self.profiler = profiler = LoopProfiler(clock)
+
+        loop_clock = self.start(p, clock)
+
+        store = writer = None
+        try:
+            # Restore the state saved by the last controller of this
+            # kettle, if recent
+            store = StateStore(state_path(self.kettle_id), clock=clock) if p.restore_window > 0.0 else None
+            if store is not None:
+                snapshot = store.load(p.restore_window)
+                if snapshot is not None:
+                    self.restore_state(p, snapshot)
+
+            # Initialize new sample triggering
+            if p.trigger == "New sample":
+                readers = [lambda: outer_sensor.instance.last_value]
+                if inner_sensor is not None:
+                    readers.append(lambda: inner_sensor.instance.last_value)
+                trigger = SampleTrigger(readers, p.min_interval, p.update_interval, clock=loop_clock)
+            else:
+                trigger = None
+
+            # Initialize fixed rate scheduling, keeping it on the
+            # controller so that its latency and jitter statistics can be
+            # inspected
+            self.scheduler = FixedRateScheduler(p.update_interval, p.overrun_policy, clock=loop_clock)
+
+            profilers.register(self.kettle_id, self.__class__.__name__, profiler, self.scheduler)
+
+            # Initialize telemetry, which is logged and written to file in the
+            # background so that the loop itself does no formatting or I/O
+            self.telemetry = TelemetryBuffer()
+            writer = TelemetryWriter(self.telemetry, self.loops,
+                                     None if p.logging == "Off" else cbpi.app.logger, LOG_PERIODS[p.logging], p.echo == "Yes",
+                                     telemetry_path(self.kettle_id, p.telemetry_file), p.telemetry_file == "Binary",
+                                     Recorder(recorder_path(self.kettle_id)) if p.recorder == "On" else None).start()
+
+            while self.is_running():
+                profiler.cycle()
+                timestamp = clock.wall()
+
+                # Read the filtered sensor values and the target, leaving
+                # out faulty readings. Readings which hold still while the
+                # output is at its maximum become stale.
+                outer = outer_sensor.read(driving)
+                if outer is not None and outer_filter is not None:
+                    outer = outer_filter.update(outer)
+                inner = inner_sensor.read(driving) if inner_sensor is not None else None
+                if inner is not None and inner_filter is not None:
+                    inner = inner_filter.update(inner)
+                target = kettle.target_temp
+                if outer is None:
+                    fault = "outer"
+                elif inner is None and inner_sensor is not None:
+                    fault = "inner"
+                else:
+                    fault = None
+                if fault != self.fault:
+                    self.handle_fault(p, fault, outer_sensor if fault == "outer" else inner_sensor, output)
+                profiler.lap("sensors")
+
+                # Compute the output, falling back to single loop control on
+                # the outer sensor or to a safe output while a sensor is
+                # faulty
+                if fault is None:
+                    output = self.compute(p, outer, inner, target)
+                else:
+                    output = None
+                    if fault == "inner" and p.sensor_fallback == "Single loop":
+                        output = self.single_loop(p, outer, target)
+                    if output is None:
+                        output = self.safe_output(p)
+                driving = self.full_output(p, output)
+                profiler.lap("control")
+
+                self.actuate(p, output)
+                profiler.lap("actuate")
+
+                # Record loop details, and save the controller state at most
+                # once a minute
+                if fault is None:
+                    self.record(p, timestamp, outer, inner, target, output)
+                else:
+                    self.record_fault(timestamp, outer, target, output)
+                if store is not None and store.due():
+                    store.save(self.current_state())
+                profiler.lap("record")
+
+                # Wait for a new sample, or until the next scheduled update
+                if trigger is not None:
+                    trigger.wait()
+                else:
+                    self.scheduler.wait()
+                    profiler.mark()
+                    if self.scheduler.overrun_warning():
+                        self.notify("%s Error" % self.label, "Update interval is too short", timeout=p.notification_timeout, type="warning")
+                        profiler.count("notifications")
+                        cbpi.app.logger.info("%s - Update interval is too short" % self.label)
+                        if p.echo == "Yes":
+                            print("%s - Update interval is too short" % self.label)
+                    if self.scheduler.cycles % 1000 == 0:
+                        self.log_statistics()
+                    profiler.lap("notify")
+        finally:
+            # Save the final state, for a restart or a handover, and release
+            # everything the loop holds, also if it failed
+            try:
+                if store is not None and store.last_save is not None:
+                    store.save(self.current_state())
+            finally:
+                self.finish(p)
+                profilers.unregister(self.kettle_id)
+                if writer is not None:
+                    writer.stop()
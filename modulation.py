@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from .clock import MonotonicClock
+
+
+class Modulator(object):
+    def __init__(self, switch, clock=None):
+        # Turns a commanded duty (%) into on/off switching of an actor by
+        # calling switch(True) or switch(False) whenever the state changes.
+        # The modulator is stepped whenever its loop sets a duty, and while
+        # the loop sleeps through a ModulatingClock.
+        self.switch = switch
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+        self.duty = 0.0
+        self.on = None
+        self.switches = 0
+
+    def set(self, duty):
+        self.duty = max(min(duty / 100.0, 1.0), 0.0)
+        self.step()
+
+    def step(self):
+        on = self.state(self.clock.time())
+        if on != self.on:
+            if self.on is not None:
+                self.switches += 1
+            self.on = on
+            self.switch(on)
+
+    def state(self, now):
+        raise NotImplementedError
+
+
+class TimeProportioning(Modulator):
+    def __init__(self, switch, window, on_min, off_min, clock=None):
+        # Switches on at the start of each window for the commanded fraction
+        # of it. Pulses shorter than on_min are skipped, and gaps shorter than
+        # off_min are filled, with the difference carried over to the next
+        # window so that the average duty is kept.
+        Modulator.__init__(self, switch, clock)
+        self.window = window
+        self.on_min = on_min
+        self.off_min = off_min
+        self.window_start = None
+        self.on_time = 0.0
+        self.carry = 0.0
+
+    def state(self, now):
+        if self.window_start is None or now - self.window_start >= 2.0 * self.window:
+            self.window_start = now - self.window
+        if now - self.window_start >= self.window:
+            self.window_start += self.window
+            on_time = self.duty * self.window + self.carry
+            if on_time < self.on_min:
+                planned = 0.0
+            elif self.window - on_time < self.off_min:
+                planned = self.window
+            else:
+                planned = on_time
+            self.carry = max(min(on_time - planned, self.window), -self.window)
+            self.on_time = planned
+        return now - self.window_start < self.on_time
+
+
+class SigmaDelta(Modulator):
+    def __init__(self, switch, hysteresis, clock=None):
+        # Keeps track of the on time owed, i.e. the integral of the commanded
+        # duty less the actual output, and switches on while on time is owed.
+        # Switching is constrained by a negative action Hysteresis on the
+        # debt, whose minimum on and off times set the switching rate. The
+        # debt carried over by these constraints is limited to one cycle.
+        Modulator.__init__(self, switch, clock)
+        self.hysteresis = hysteresis
+        self.limit = max(hysteresis.on_min + hysteresis.off_min, 1.0)
+        self.owed = 0.0
+        self.last_time = None
+
+    def state(self, now):
+        if self.last_time is not None:
+            self.owed += (self.duty - (1.0 if self.hysteresis.on else 0.0)) * (now - self.last_time)
+            self.owed = max(min(self.owed, self.limit), -self.limit)
+        self.last_time = now
+        # Nothing is owed at zero duty
+        return self.hysteresis.update(self.owed if self.duty > 0.0 else -self.limit, 0.0)
+
+
+class ModulatingClock(object):
+    def __init__(self, clock, modulator, resolution=0.5):
+        # A clock which keeps stepping a modulator every resolution seconds
+        # while sleeping, so that switching times do not depend on the loop's
+        # update interval
+        self.clock = clock
+        self.modulator = modulator
+        self.resolution = resolution
+
+    def time(self):
+        return self.clock.time()
+
+    def wall(self):
+        return self.clock.wall()
+
+    def sleep(self, seconds):
+        deadline = self.clock.time() + seconds
+        while True:
+            self.modulator.step()
+            remaining = deadline - self.clock.time()
+            if remaining <= 0.0:
+                break
+            self.clock.sleep(min(self.resolution, remaining))
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+
+class RecursiveLeastSquares(object):
+    def __init__(self, parameters, variances, forgetting=0.999):
+        # Estimates the parameters of a linear regression, value = parameters
+        # · regressors, online. Old samples are forgotten exponentially with
+        # the given factor, so that the estimates follow slow changes of the
+        # process. Estimation starts from the given parameters, with the
+        # given variances expressing how far off they may be. Forgetting is
+        # suspended while the variances exceed these, as they do when the
+        # regressors hold still, so that the estimates do not blow up.
+        self.parameters = list(parameters)
+        self.size = len(self.parameters)
+        self.covariance = [[variances[i] if i == j else 0.0 for j in range(self.size)] for i in range(self.size)]
+        self.max_trace = sum(variances)
+        self.forgetting = forgetting
+
+    def update(self, regressors, value):
+        # Update the estimates from a sample, returning its prediction error
+        n = self.size
+        p = self.covariance
+        px = [sum(p[i][j] * regressors[j] for j in range(n)) for i in range(n)]
+        trace = sum(p[i][i] for i in range(n))
+        forgetting = self.forgetting if trace < self.max_trace else 1.0
+        gain = [v / (forgetting + sum(x * v for x, v in zip(regressors, px))) for v in px]
+        error = value - sum(t * x for t, x in zip(self.parameters, regressors))
+        self.parameters = [t + g * error for t, g in zip(self.parameters, gain)]
+        self.covariance = [[(p[i][j] - gain[i] * px[j]) / forgetting for j in range(n)] for i in range(n)]
+        return error
+
+
+class ThermalModel(object):
+    def __init__(self, step, ambient, forgetting=0.999):
+        # Two node model of a HERMS or RIMS brewery over steps of the given
+        # length (s), identified online from the output and the inner and
+        # outer temperatures. Over each step, the inner node (coil, HLT or
+        # tube) is heated by the output and exchanges heat with the outer
+        # node (mash), and both lose heat to ambient:
+        #
+        #   inner change = heating * output + delayed heating * last output
+        #                  + coupling * (outer - inner) + inner loss * (ambient - inner)
+        #   outer change = coupling * (inner - outer) + outer loss * (ambient - outer)
+        #
+        # where last output is the average output over the previous step,
+        # which takes up a dead time of up to a step without biasing the
+        # other parameters. The parameters start from those of a typical
+        # setup, heating the inner node by 1 ° per minute at full output, and
+        # are refined by recursive least squares after every step.
+        self.step = step
+        self.ambient = ambient
+        inner = [step / 6000.0, 0.0, step / 600.0, step / 20000.0]
+        outer = [step / 600.0, step / 20000.0]
+
+        # Allow each parameter to be off by ten times its typical value
+        self.inner = RecursiveLeastSquares(inner, [100.0 * (step / 6000.0) ** 2] * 2 + [100.0 * value ** 2 for value in inner[2:]], forgetting)
+        self.outer = RecursiveLeastSquares(outer, [100.0 * value ** 2 for value in outer], forgetting)
+
+        # Incremented whenever the parameters change
+        self.version = 0
+
+        # Start of the current step, the output applied over it so far, and
+        # the average output over the previous step
+        self.start = None
+        self.last_time = None
+        self.output_time = 0.0
+        self.last_output = 0.0
+
+    def observe(self, now, output, inner, outer):
+        # Observe the temperatures at the given time, given the output
+        # applied since the last observation, and identify the model from
+        # each completed step
+        if self.start is None:
+            self.start = (now, inner, outer)
+            self.last_time = now
+            return
+        self.output_time += output * (now - self.last_time)
+        self.last_time = now
+        start_time, start_inner, start_outer = self.start
+        elapsed = now - start_time
+        if elapsed < self.step:
+            return
+
+        # Rescale the changes observed to a whole step
+        scale = self.step / elapsed
+        output = self.output_time / elapsed
+        self.inner.update([output, self.last_output, start_outer - start_inner, self.ambient - start_inner], (inner - start_inner) * scale)
+        self.outer.update([start_inner - start_outer, self.ambient - start_outer], (outer - start_outer) * scale)
+        self.last_output = output
+
+        # Keep the parameters physical, and the model stable
+        self.inner.parameters = [max(value, 1e-6) for value in self.inner.parameters]
+        self.outer.parameters = [max(value, 1e-6) for value in self.outer.parameters]
+        self.inner.parameters[2] = min(self.inner.parameters[2], 0.5)
+        self.inner.parameters[3] = min(self.inner.parameters[3], 0.5)
+        self.outer.parameters[0] = min(self.outer.parameters[0], 0.5)
+        self.outer.parameters[1] = min(self.outer.parameters[1], 0.5)
+        self.version += 1
+
+        self.start = (now, inner, outer)
+        self.output_time = 0.0
+
+    def restart(self):
+        # Discard the current step, e.g. after the temperatures could not be
+        # observed for a while, and start a new one at the next observation
+        self.start = None
+        self.output_time = 0.0
+
+    def advance(self, inner, outer, output, last_output):
+        # The inner and outer temperatures one step ahead
+        heating, delayed_heating, inner_coupling, inner_loss = self.inner.parameters
+        outer_coupling, outer_loss = self.outer.parameters
+        return (inner + heating * output + delayed_heating * last_output + inner_coupling * (outer - inner) + inner_loss * (self.ambient - inner),
+                outer + outer_coupling * (inner - outer) + outer_loss * (self.ambient - outer))
+
+
+def block_lengths(steps):
+    # Split a horizon into blocks over which the output is held, doubling in
+    # length so that near moves are finely resolved with few variables
+    lengths = []
+    length = 1
+    while sum(lengths) < steps:
+        lengths.append(min(length, steps - sum(lengths)))
+        length *= 2
+    return lengths
+
+
+def solve_linear(matrix, vector):
+    # Solve a small positive definite system by Gaussian elimination
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(rows[r][i]))
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for r in range(i + 1, n):
+            factor = rows[r][i] / rows[i][i]
+            for c in range(i, n + 1):
+                rows[r][c] -= factor * rows[i][c]
+    solution = [0.0] * n
+    for i in reversed(range(n)):
+        solution[i] = (rows[i][n] - sum(rows[i][c] * solution[c] for c in range(i + 1, n))) / rows[i][i]
+    return solution
+
+
+def box_qp(hessian, linear, start, upper, iterations=50):
+    # Minimize 1/2 x·H·x + c·x subject to 0 <= x <= upper with a primal
+    # active set method, starting from the given point and taking the
+    # variables at their bounds there as the initial active set. A warm
+    # start from the last solution usually needs a single iteration.
+    n = len(linear)
+    x = [max(min(value, upper), 0.0) for value in start]
+    active = set(i for i in range(n) if x[i] <= 0.0 or x[i] >= upper)
+    for _ in range(iterations):
+        free = [i for i in range(n) if i not in active]
+        if free:
+            # Newton step on the free variables, stopping at the first bound
+            target = solve_linear([[hessian[i][j] for j in free] for i in free],
+                                  [-linear[i] - sum(hessian[i][j] * x[j] for j in active) for i in free])
+            fraction = 1.0
+            blocking = None
+            for i, value in zip(free, target):
+                if value < 0.0 and x[i] - value > 0.0 and x[i] / (x[i] - value) < fraction:
+                    fraction, blocking = x[i] / (x[i] - value), i
+                elif value > upper and value - x[i] > 0.0 and (upper - x[i]) / (value - x[i]) < fraction:
+                    fraction, blocking = (upper - x[i]) / (value - x[i]), i
+            for i, value in zip(free, target):
+                x[i] += fraction * (value - x[i])
+            if blocking is not None:
+                x[blocking] = 0.0 if x[blocking] < upper / 2.0 else upper
+                active.add(blocking)
+                continue
+
+        # Release the bound variable whose gradient points most into the
+        # feasible region, or stop if there is none
+        gradient = [sum(h * value for h, value in zip(hessian[i], x)) + linear[i] for i in range(n)]
+        release = None
+        best = 0.0
+        for i in active:
+            pull = -gradient[i] if x[i] <= 0.0 else gradient[i]
+            if pull > best:
+                release, best = i, pull
+        if release is None:
+            break
+        active.remove(release)
+    return x
+
+
+class PredictiveController(object):
+    def __init__(self, model, steps, output_max, inner_max, move_penalty=0.01, constraint_penalty=100.0, iterations=10):
+        # Model predictive control of the outer temperature through the
+        # output, over a horizon of the given number of model steps. Each
+        # solve minimizes
+        #
+        #   sum of (outer - target)² + move penalty * sum of (output change)²
+        #     + constraint penalty * sum of (inner - inner max)² where above
+        #
+        # over the predicted horizon, subject to 0 <= output <= output max,
+        # with the output held over blocks of doubling length. The responses
+        # and the Hessian of the first two terms are computed once per model
+        # update. Each solve is then a box constrained QP in a handful of
+        # variables, warm started from the last solution, which is repeated
+        # while the set of steps predicted to exceed the inner maximum
+        # changes. It takes around a millisecond.
+        self.model = model
+        self.lengths = block_lengths(steps)
+        self.steps = steps
+        self.output_max = output_max
+        self.inner_max = inner_max
+        self.move_penalty = move_penalty
+        self.constraint_penalty = constraint_penalty
+        self.iterations = iterations
+        self.version = None
+        self.outputs = [0.0] * len(self.lengths)
+
+        # Predictions of the last solve
+        self.inner_prediction = []
+        self.outer_prediction = []
+
+    def prepare(self):
+        # Compute the responses of the inner and outer temperatures over the
+        # horizon to a unit output over each block, and the Hessian of the
+        # tracking and move terms
+        model = self.model
+        ambient = model.ambient
+        blocks = len(self.lengths)
+        self.inner_response = [[0.0] * blocks for _ in range(self.steps)]
+        self.outer_response = [[0.0] * blocks for _ in range(self.steps)]
+        start = 0
+        for block, length in enumerate(self.lengths):
+            inner = outer = ambient
+            output = 0.0
+            for step in range(self.steps):
+                last_output = output
+                output = 1.0 if start <= step < start + length else 0.0
+                inner, outer = model.advance(inner, outer, output, last_output)
+                self.inner_response[step][block] = inner - ambient
+                self.outer_response[step][block] = outer - ambient
+            start += length
+        self.hessian = [[2.0 * sum(row[i] * row[j] for row in self.outer_response) for j in range(blocks)] for i in range(blocks)]
+        for i in range(blocks):
+            self.hessian[i][i] += 2.0 * self.move_penalty * (2.0 if i + 1 < blocks else 1.0)
+            if i + 1 < blocks:
+                self.hessian[i][i + 1] -= 2.0 * self.move_penalty
+                self.hessian[i + 1][i] -= 2.0 * self.move_penalty
+        self.version = model.version
+
+    def solve(self, inner, outer, target, last_output):
+        # The output to apply now, from the current temperatures and target
+        # and the output applied last
+        if self.version != self.model.version:
+            self.prepare()
+        blocks = len(self.lengths)
+
+        # Free responses, with the output off from now on
+        free_inner = []
+        free_outer = []
+        previous = self.model.last_output
+        for _ in range(self.steps):
+            inner, outer = self.model.advance(inner, outer, 0.0, previous)
+            previous = 0.0
+            free_inner.append(inner)
+            free_outer.append(outer)
+
+        # Linear term of the tracking and move terms
+        linear = [2.0 * sum(row[i] * (free - target) for row, free in zip(self.outer_response, free_outer)) for i in range(blocks)]
+        linear[0] -= 2.0 * self.move_penalty * last_output
+
+        # Solve, penalizing the steps predicted to exceed the inner maximum
+        # until these no longer change
+        outputs = self.outputs
+        penalized = []
+        for _ in range(self.iterations):
+            hessian = [list(row) for row in self.hessian]
+            penalized_linear = list(linear)
+            for step in penalized:
+                row = self.inner_response[step]
+                for i in range(blocks):
+                    penalized_linear[i] += 2.0 * self.constraint_penalty * row[i] * (free_inner[step] - self.inner_max)
+                    for j in range(blocks):
+                        hessian[i][j] += 2.0 * self.constraint_penalty * row[i] * row[j]
+            outputs = box_qp(hessian, penalized_linear, outputs, self.output_max)
+            self.inner_prediction = [free + sum(a * u for a, u in zip(row, outputs)) for row, free in zip(self.inner_response, free_inner)]
+            exceeding = [step for step in range(self.steps) if self.inner_prediction[step] > self.inner_max]
+            if all(step in penalized for step in exceeding):
+                break
+            penalized = sorted(set(penalized) | set(exceeding))
+        self.outputs = outputs
+
+        # Keep the outer prediction for inspection
+        self.outer_prediction = [free + sum(a * u for a, u in zip(row, outputs)) for row, free in zip(self.outer_response, free_outer)]
+        return outputs[0]
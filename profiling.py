@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+import time
+
+from .clock import MonotonicClock
+
+# High resolution timer for spans, time.time on Python 2
+_timer = getattr(time, "perf_counter", time.time)
+
+
+class Span(object):
+    __slots__ = ("count", "total", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+
+class LoopProfiler(object):
+    def __init__(self, clock=None):
+        # Timing spans within each loop iteration, counters, and the time
+        # spent in given states (e.g. with the output saturated). A cycle
+        # starts the first span, and each lap ends the current span, adding
+        # its duration to the named span and starting the next. Spans are
+        # timed with a high resolution timer, and take around a microsecond.
+        # State durations are measured with the loop's clock.
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+        self.spans = {}
+        self.counters = {"cycles": 0}
+        self.gauges = {}
+        self.states = {}
+        self.durations = {}
+        self.last_cycle = None
+        self.mark_time = _timer()
+
+    def cycle(self):
+        # Start an iteration, adding the time since the last one to the
+        # states which were on
+        now = self.clock.time()
+        if self.last_cycle is not None:
+            elapsed = now - self.last_cycle
+            for name, on in self.states.items():
+                if on:
+                    self.durations[name] += elapsed
+        self.last_cycle = now
+        self.counters["cycles"] += 1
+        self.mark_time = _timer()
+
+    def mark(self):
+        # Start a span without ending one, e.g. after sleeping
+        self.mark_time = _timer()
+
+    def lap(self, name):
+        now = _timer()
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = Span()
+        span.add(now - self.mark_time)
+        self.mark_time = now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        # A counter kept elsewhere, read when a snapshot is taken
+        self.gauges[name] = read
+
+    def state(self, name, on):
+        if name not in self.durations:
+            self.durations[name] = 0.0
+        self.states[name] = on
+
+    def snapshot(self):
+        cycles = max(self.counters["cycles"], 1)
+        counters = dict(self.counters)
+        for name, read in list(self.gauges.items()):
+            counters[name] = read()
+        return {
+            "spans": dict((name, {
+                "count": span.count,
+                "total_ms": 1000.0 * span.total,
+                "per_cycle_ms": 1000.0 * span.total / cycles,
+                "max_ms": 1000.0 * span.maximum}) for name, span in list(self.spans.items())),
+            "counters": counters,
+            "state_seconds": dict(self.durations)}
+
+
+class ProfilerRegistry(object):
+    def __init__(self):
+        # The profilers of the running controllers by kettle, with their
+        # schedulers and threads
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def register(self, kettle_id, controller, profiler, scheduler):
+        with self.lock:
+            self.entries[kettle_id] = (controller, profiler, scheduler, threading.current_thread().ident)
+
+    def unregister(self, kettle_id):
+        with self.lock:
+            self.entries.pop(kettle_id, None)
+
+    def threads(self):
+        with self.lock:
+            return set(entry[3] for entry in self.entries.values())
+
+    def snapshot(self, kettle_id=None):
+        with self.lock:
+            entries = dict(self.entries)
+        metrics = {}
+        for key, (controller, profiler, scheduler, _) in entries.items():
+            if kettle_id is not None and str(key) != str(kettle_id):
+                continue
+            snapshot = profiler.snapshot()
+            snapshot["controller"] = controller
+            snapshot["scheduler"] = scheduler.stats()
+            metrics[str(key)] = snapshot
+        return metrics
+
+
+class SamplingProfiler(object):
+    def __init__(self, registry, interval=0.005):
+        # Samples the stacks of the controller threads every interval
+        # seconds from a background thread while running, counting for each
+        # function the samples in which it was running itself, and in which
+        # it was on the stack at all. Sampling costs the controllers nothing
+        # but the time the background thread holds the interpreter lock.
+        self.registry = registry
+        self.interval = interval
+        self.samples = 0
+        self.own = {}
+        self.total = {}
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self.samples = 0
+            self.own = {}
+            self.total = {}
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="CascadeControl sampling profiler")
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            threads = self.registry.threads()
+            for ident, frame in sys._current_frames().items():
+                if ident not in threads:
+                    continue
+                self.samples += 1
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+                    if top:
+                        self.own[key] = self.own.get(key, 0) + 1
+                        top = False
+                    if key not in seen:
+                        seen.add(key)
+                        self.total[key] = self.total.get(key, 0) + 1
+                    frame = frame.f_back
+
+    def snapshot(self, top=25):
+        own = sorted(self.own.items(), key=lambda item: -item[1])[:top]
+        total = sorted(self.total.items(), key=lambda item: -item[1])[:top]
+        return {"running": self.running, "interval": self.interval, "samples": self.samples, "own": own, "total": total}
+
+
+# Shared by all controllers in this process
+profilers = ProfilerRegistry()
+sampler = SamplingProfiler(profilers)
+
+
+def register_endpoints(app, url_prefix="/api/cascadecontrol"):
+    # Serve the metrics of the running controllers as JSON from the
+    # CraftBeerPi web server, at GET <prefix>/metrics (or /metrics/<kettle
+    # id>), and the sampling profiler at GET <prefix>/profiler, started and
+    # stopped by POST <prefix>/profiler/start and /stop. Flask is imported
+    # here as it is only available within CraftBeerPi.
+    from flask import Blueprint, Response
+
+    blueprint = Blueprint("cascadecontrol", __name__)
+
+    def respond(data):
+        return Response(json.dumps(data), mimetype="application/json")
+
+    @blueprint.route("/metrics", methods=["GET"])
+    def metrics():
+        return respond(profilers.snapshot())
+
+    @blueprint.route("/metrics/<kettle_id>", methods=["GET"])
+    def kettle_metrics(kettle_id):
+        return respond(profilers.snapshot(kettle_id))
+
+    @blueprint.route("/profiler", methods=["GET"])
+    def profiler():
+        return respond(sampler.snapshot())
+
+    @blueprint.route("/profiler/start", methods=["POST"])
+    def start_profiler():
+        sampler.start()
+        return respond(sampler.snapshot())
+
+    @blueprint.route("/profiler/stop", methods=["POST"])
+    def stop_profiler():
+        sampler.stop()
+        return respond(sampler.snapshot())
+
+    app.register_blueprint(blueprint, url_prefix=url_prefix)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+import os
+import struct
+
+from .telemetry import FIELDS, WIDTH
+
+# Recordings are append-only files of fixed size blocks. Each block holds
+# BLOCK_ROWS records stored column by column, so that a column of a block is
+# contiguous on disk and can be mapped without reading the rest of the file.
+# Times are stored as doubles, everything else as floats, in native byte
+# order. The header holds a magic string, the rows per block, and the number
+# of rows written so far.
+MAGIC = b"CCREC1\0\0"
+HEADER = struct.Struct("=8sqq")
+HEADER_SIZE = 64
+BLOCK_ROWS = 4096
+TYPECODES = ["d"] + ["f"] * (WIDTH - 1)
+DTYPES = ["=f8"] + ["=f4"] * (WIDTH - 1)
+
+
+def recorder_path(kettle_id):
+    return os.path.join("logs", "cascadecontrol_kettle_%s.rec" % kettle_id)
+
+
+class Recorder(object):
+    def __init__(self, path, block_rows=BLOCK_ROWS):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, block_rows, 0).ljust(HEADER_SIZE, b"\0"))
+        self.file = open(path, "r+b")
+        self.block_rows, self.rows = read_header(self.file)
+
+        # Byte offsets of each column within a block, and the block size
+        self.sizes = [struct.calcsize(typecode) for typecode in TYPECODES]
+        self.offsets = [self.block_rows * sum(self.sizes[:column]) for column in range(WIDTH)]
+        self.block_size = self.block_rows * sum(self.sizes)
+
+    def close(self):
+        self.file.close()
+
+    def append(self, records):
+        # Append a flat array of telemetry records, as drained from a
+        # TelemetryBuffer, writing each column of each block in one piece
+        total = len(records) // WIDTH
+        start = 0
+        while start < total:
+            block, row = divmod(self.rows, self.block_rows)
+            if row == 0:
+                # Allocate the whole block up front so it can always be mapped
+                self.file.truncate(HEADER_SIZE + (block + 1) * self.block_size)
+            count = min(self.block_rows - row, total - start)
+            for column in range(WIDTH):
+                values = array.array(TYPECODES[column], records[start * WIDTH + column:(start + count) * WIDTH:WIDTH])
+                self.file.seek(HEADER_SIZE + block * self.block_size + self.offsets[column] + row * self.sizes[column])
+                values.tofile(self.file)
+            self.rows += count
+            start += count
+
+        # Only publish the new rows once they have been written
+        self.file.flush()
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.block_rows, self.rows))
+        self.file.flush()
+
+
+def read_header(f):
+    f.seek(0)
+    magic, block_rows, rows = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a CascadeControl recording")
+    return block_rows, rows
+
+
+class Recording(object):
+    def __init__(self, path):
+        # Read access to a recording through a memory map, so that queries
+        # only page in the blocks they touch however large the file grows.
+        # Records are assumed to be appended in time order.
+        import numpy as np
+        self.np = np
+        with open(path, "rb") as f:
+            self.block_rows, self.rows = read_header(f)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r")
+        sizes = [np.dtype(dtype).itemsize for dtype in DTYPES]
+        self.offsets = [self.block_rows * sum(sizes[:column]) for column in range(WIDTH)]
+        self.block_size = self.block_rows * sum(sizes)
+        self.blocks = (self.rows + self.block_rows - 1) // self.block_rows
+
+        # The first time of each block, for locating blocks by time
+        self.block_times = [self.column(block, 0)[0] for block in range(self.blocks)]
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, block, column):
+        # A zero-copy view of one column of one block
+        count = min(self.block_rows, self.rows - block * self.block_rows)
+        offset = HEADER_SIZE + block * self.block_size + self.offsets[column]
+        return self.np.frombuffer(self.map, dtype=DTYPES[column], count=count, offset=offset)
+
+    def locate(self, time):
+        # Index of the first row at or after the given time
+        block = max(bisect.bisect_right(self.block_times, time) - 1, 0)
+        if block >= self.blocks:
+            return self.rows
+        return block * self.block_rows + int(self.np.searchsorted(self.column(block, 0), time, side="left"))
+
+    def chunks(self, start, end, fields):
+        # Yield (fields...) arrays for each block overlapping the time range
+        first, last = self.locate(start), self.locate(end)
+        row = first
+        while row < last:
+            block, offset = divmod(row, self.block_rows)
+            stop = min(last - block * self.block_rows, self.block_rows)
+            yield [self.column(block, FIELDS.index(field))[offset:stop] for field in fields]
+            row = block * self.block_rows + stop
+
+    def query(self, start, end, loop=None, fields=FIELDS):
+        # Records between start (inclusive) and end (exclusive) times as a
+        # dict of arrays, optionally for one loop only
+        np = self.np
+        columns = list(fields) + ["loop"]
+        chunks = list(self.chunks(start, end, columns))
+        if chunks:
+            data = [np.concatenate([chunk[i] for chunk in chunks]) for i in range(len(columns))]
+        else:
+            data = [np.zeros(0, dtype=DTYPES[FIELDS.index(field)]) for field in columns]
+        if loop is not None:
+            mask = data[-1] == loop
+            data = [values[mask] for values in data]
+        return dict(zip(fields, data))
+
+    def downsample(self, start, end, points, field="actual", loop=0):
+        # Minimum, maximum and mean of a field in up to the given number of
+        # equal time buckets, for charting long time ranges. Data is reduced
+        # block by block, so memory use does not grow with the range.
+        np = self.np
+        edges = np.linspace(start, end, points + 1)
+        minimum = np.full(points, np.inf)
+        maximum = np.full(points, -np.inf)
+        total = np.zeros(points)
+        count = np.zeros(points)
+        for times, values, loops in self.chunks(start, end, ["time", field, "loop"]):
+            mask = loops == loop
+            times, values = times[mask], values[mask].astype(float)
+            buckets = np.clip(np.searchsorted(edges, times, side="right") - 1, 0, points - 1)
+            np.minimum.at(minimum, buckets, values)
+            np.maximum.at(maximum, buckets, values)
+            total += np.bincount(buckets, values, points)
+            count += np.bincount(buckets, None, points)
+        filled = count > 0
+        centers = (edges[:-1] + edges[1:]) / 2.0
+        return {
+            "time": centers[filled],
+            "min": minimum[filled],
+            "max": maximum[filled],
+            "mean": total[filled] / count[filled]}
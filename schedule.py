@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import bisect
+
+
+class GainSchedule(object):
+    def __init__(self, points, resolution=0.25):
+        # Gains (kp, ki, kd) scheduled on a temperature, interpolated linearly
+        # between (temperature, kp, ki, kd) points and held beyond the first
+        # and last points. The schedule is precomputed into a table with one
+        # entry per resolution degrees, so that a lookup takes constant time
+        # and returns the same tuple for every temperature within an entry.
+        points = sorted(points)
+        temperatures = [point[0] for point in points]
+        self.start = temperatures[0]
+        self.resolution = resolution
+        self.table = []
+        for i in range(int((temperatures[-1] - self.start) / resolution) + 2):
+            temperature = self.start + i * resolution
+            upper = min(bisect.bisect_right(temperatures, temperature), len(points) - 1)
+            lower = max(upper - 1, 0)
+            span = temperatures[upper] - temperatures[lower]
+            fraction = min(max((temperature - temperatures[lower]) / span, 0.0), 1.0) if span else 0.0
+            self.table.append(tuple(
+                low + (high - low) * fraction for low, high in zip(points[lower][1:], points[upper][1:])))
+
+    def lookup(self, temperature):
+        index = int((temperature - self.start) / self.resolution + 0.5)
+        return self.table[max(min(index, len(self.table) - 1), 0)]
+
+
+def parse_schedule(spec):
+    # Parse a comma separated gain schedule such as "65:10:0.5:1, 100:30:0.1:0"
+    # of temperature:kp:ki:kd points into a GainSchedule, or None if empty
+    points = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            point = tuple(float(value) for value in item.split(":"))
+        except ValueError:
+            point = ()
+        if len(point) != 4 or min(point[1:]) < 0.0:
+            raise ValueError("Invalid gain schedule point: %s" % item)
+        points.append(point)
+    if not points:
+        return None
+    return GainSchedule(points)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import bisect
+
+from .clock import MonotonicClock
+
+# Upper bounds of histogram bins in seconds, roughly logarithmic
+HISTOGRAM_BINS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, float("inf")]
+
+
+class Histogram(object):
+    def __init__(self, bins=HISTOGRAM_BINS):
+        # Fixed bins keep memory use constant however long a loop runs.
+        # Percentiles are reported as the upper bound of their bin.
+        self.bins = bins
+        self.counts = [0] * len(bins)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bins, value)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        threshold = p / 100.0 * self.count
+        total = 0
+        for bound, count in zip(self.bins, self.counts):
+            total += count
+            if total >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        return {"p50": self.percentile(50), "p99": self.percentile(99), "max": self.max}
+
+
+class FixedRateScheduler(object):
+    def __init__(self, interval, policy="Skip", max_backlog=10, warning_period=600.0, clock=None):
+        # Schedules loop cycles at fixed times start + n * interval, so that
+        # the time spent executing each cycle does not accumulate as drift
+        self.interval = interval
+
+        # When a cycle overruns its slot, "Skip" drops the missed cycles and
+        # resumes at the next slot, while "Catch up" runs the missed cycles
+        # back to back, up to max_backlog cycles before resynchronizing
+        self.policy = policy
+        self.max_backlog = max_backlog
+
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        self.next_time = self.clock.time() + interval
+        self.last_wake = None
+
+        # Lateness of each wake up relative to its slot, and deviation of each
+        # period from the interval
+        self.latency = Histogram()
+        self.jitter = Histogram()
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+
+        # Whether the cycles are running back to back to catch up with an
+        # overrun, which counts once rather than for every cycle caught up
+        self.catching_up = False
+        self.resyncs = 0
+
+        # Overrun warnings are limited to one per warning period
+        self.warning_period = warning_period
+        self.last_warning = None
+        self.warned_overruns = 0
+
+    def wait(self):
+        # Sleep until the next slot, returning the number of missed slots
+        now = self.clock.time()
+
+        # Re-anchor the schedule if the clock has stepped backward by more
+        # than a slot, as a wall clock fallback may on an NTP correction,
+        # rather than sleeping out the step with the output held
+        if now < self.next_time - self.interval:
+            self.next_time = now + self.interval
+            self.last_wake = None
+            self.resyncs += 1
+
+        if now < self.next_time:
+            self.clock.sleep(self.next_time - now)
+            missed = 0
+            self.catching_up = False
+        else:
+            if not self.catching_up:
+                self.overruns += 1
+            missed = int((now - self.next_time) / self.interval)
+
+        wake = self.clock.time()
+        self.latency.add(max(wake - self.next_time, 0.0))
+        if self.last_wake is not None:
+            self.jitter.add(abs(wake - self.last_wake - self.interval))
+        self.last_wake = wake
+        self.cycles += 1
+
+        if self.policy == "Catch up" and missed <= self.max_backlog:
+            self.next_time += self.interval
+            self.catching_up = wake >= self.next_time
+        else:
+            self.skipped += missed
+            self.next_time += (missed + 1) * self.interval
+            self.catching_up = False
+        return missed
+
+    def overrun_warning(self):
+        # Whether to warn about new overruns, at most once per warning period
+        now = self.clock.time()
+        if self.overruns > self.warned_overruns and (self.last_warning is None or now - self.last_warning >= self.warning_period):
+            self.last_warning = now
+            self.warned_overruns = self.overruns
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "cycles": self.cycles,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "resyncs": self.resyncs,
+            "latency": self.latency.stats(),
+            "jitter": self.jitter.stats()}
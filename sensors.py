@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from .clock import MonotonicClock
+
+
+class SensorMonitor(object):
+    def __init__(self, instance, low=float("-inf"), high=float("inf"), stale_timeout=0.0, clock=None):
+        # Reads a CraftBeerPi sensor instance, kept rather than looked up on
+        # every read, and checks each reading. A reading has failed if the
+        # sensor raises or gives no number, and is out of range outside
+        # [low, high] (e.g. the -127 °C of a DS18B20 which dropped off the
+        # bus). It is stale once it has not changed while the loop drove the
+        # temperature as hard as it could for stale_timeout seconds, as when
+        # a sensor stops delivering samples and keeps its last value, or
+        # freezes. CraftBeerPi sensors do not timestamp their samples, so
+        # samples are timestamped when their value changes, and a reading
+        # holding still while the loop is not driving it (e.g. a well held
+        # mash) is not stale. A stale_timeout of 0 disables the check.
+        self.instance = instance
+        self.low = low
+        self.high = high
+        self.stale_timeout = stale_timeout
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        # Last valid reading, the time driven since it changed, and the time
+        # of the last read
+        self.value = None
+        self.driven = 0.0
+        self.last_read = self.clock.time()
+
+        # The current fault ("failed", "out of range" or "stale"), or None,
+        # and the number of faults so far
+        self.fault = None
+        self.faults = 0
+
+    def read(self, driving=False):
+        # The current reading, or None if it is faulty, given whether the
+        # loop has been driving the temperature since the last read
+        now = self.clock.time()
+        elapsed = now - self.last_read
+        self.last_read = now
+        try:
+            value = float(self.instance.last_value)
+        except Exception:
+            # Whatever the sensor raises, e.g. TypeError for a missing value
+            value = None
+        if value is None or value != value:
+            fault = "failed"
+        elif not self.low <= value <= self.high:
+            fault = "out of range"
+        elif value != self.value:
+            fault = None
+            self.driven = 0.0
+        else:
+            if driving:
+                self.driven += elapsed
+            if self.stale_timeout > 0.0 and self.driven > self.stale_timeout:
+                fault = "stale"
+            else:
+                fault = None
+
+        if fault is not None and self.fault is None:
+            self.faults += 1
+        self.fault = fault
+        if fault is None:
+            self.value = value
+            return value
+
+        # Forget the last reading after a failure, so that the next valid
+        # reading starts a new sample even if it has the same value
+        if fault != "stale":
+            self.value = None
+        return None
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from .clock import MonotonicClock
+
+
+class SetpointRamp(object):
+    def __init__(self, rate, clock=None):
+        # Moves a setpoint towards its target at no more than rate degrees per
+        # minute, so that a step in the target does not kick the loop into
+        # saturation. A rate of zero disables ramping.
+        self.rate = abs(rate) / 60.0
+
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        self.last_time = None
+        self.setpoint = None
+
+    def update(self, target, current):
+        # Return the ramped setpoint. The ramp starts from the current value,
+        # and never holds the setpoint on the far side of the current value,
+        # so that a process which moves faster than the ramp is not held back.
+        now = self.clock.time()
+        if self.rate <= 0.0:
+            self.setpoint = target
+        elif self.setpoint is None:
+            self.setpoint = current
+        else:
+            step = self.rate * (now - self.last_time)
+            if self.setpoint < target:
+                self.setpoint = min(max(self.setpoint + step, min(current, target)), target)
+            else:
+                self.setpoint = max(min(self.setpoint - step, max(current, target)), target)
+        self.last_time = now
+        return self.setpoint
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+# Offline simulation of the CascadeControl controllers. Run the benchmark
+# from the plugin directory with `python -m simulation.benchmark`.
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+import time
+
+from .fakecbpi import Actor, Kettle, Sensor, cbpi, load_plugin
+from .models import FirstOrderDeadTime, TwoNode
+
+plugin = load_plugin()
+
+# CPU time of this process, time.clock on Python 2
+_cpu_time = getattr(time, "process_time", getattr(time, "clock", None))
+
+# Mash profile of (time in seconds, target temperature) steps
+DEFAULT_PROFILE = [(0.0, 65.0), (3600.0, 72.0), (5400.0, 78.0)]
+DEFAULT_DURATION = 6600.0
+
+# Properties needed for the controllers to run with their defaults, without
+# recording or saving state to disk
+DEFAULT_PROPERTIES = {
+    "CascadePID": {"a_inner_sensor": u"2", "v_recorder": "Off", "zn_restore_window": 0},
+    "AdvancedPID": {"p_recorder": "Off", "z_restore_window": 0},
+    "CascadeHysteresis": {"ba_inner_sensor": u"2", "k_recorder": "Off", "q_restore_window": 0},
+    "AdvancedHysteresis": {"m_recorder": "Off", "o_restore_window": 0},
+    "CascadeMPC": {"a_inner_sensor": u"2", "q_recorder": "Off"},
+}
+
+PLANTS = {
+    "two-node": lambda: TwoNode(initial=50.0),
+    "fopdt": lambda: FirstOrderDeadTime(initial=50.0),
+}
+
+# Properties of the autotuning controllers: autotune switch, and the gains
+# and initial integrator of each PID by attribute name
+AUTOTUNE_PROPERTIES = {
+    "CascadePID": ("n_autotune", {
+        "outer_pid": ("h_outer_kp", "i_outer_ki", "j_outer_kd", "k_outer_integrator_initial"),
+        "inner_pid": ("b_inner_kp", "c_inner_ki", "d_inner_kd", "e_inner_integrator_initial")}),
+    "AdvancedPID": ("h_autotune", {
+        "pid": ("a_kp", "b_ki", "c_kd", "e_integrator_initial")}),
+}
+
+# Long enough for the autotune experiments to complete on both plants
+AUTOTUNE_DURATION = 21600.0
+
+
+class SimulationClock(plugin.clock.VirtualClock):
+    def __init__(self, plant, actor, kettle, profile, metrics):
+        # A virtual clock which steps the plant, applies the setpoint
+        # profile, and records the response whenever the controller sleeps
+        plugin.clock.VirtualClock.__init__(self)
+        self.plant = plant
+        self.actor = actor
+        self.kettle = kettle
+        self.profile = profile
+        self.metrics = metrics
+        self.plant_time = 0.0
+
+    def advance(self, seconds):
+        plugin.clock.VirtualClock.advance(self, seconds)
+        while self.plant_time + self.plant.step <= self.now:
+            for step_time, target in self.profile:
+                if step_time <= self.plant_time:
+                    self.kettle.target_temp = target
+            self.plant.advance(self.actor.output, self.plant.step)
+            self.plant_time += self.plant.step
+            self.metrics.sample(self.plant_time, self.kettle.target_temp, self.plant.outer, self.plant.step)
+
+
+class Metrics(object):
+    def __init__(self, band=0.5):
+        # Error band (°) within which the process is considered settled
+        self.band = band
+        self.samples = []
+
+    def sample(self, time, target, value, step):
+        self.samples.append((time, target, value, step))
+
+    def segments(self):
+        # Split the samples into segments of constant target
+        segments = []
+        for sample in self.samples:
+            if not segments or segments[-1][-1][1] != sample[1]:
+                segments.append([])
+            segments[-1].append(sample)
+        return segments
+
+    def summary(self):
+        settling_times = []
+        overshoots = []
+        iae = 0.0
+        itae = 0.0
+        for segment in self.segments():
+            start, target, initial, _ = segment[0]
+            rising = target >= initial
+            settled = start
+            overshoot = 0.0
+            for time, _, value, step in segment:
+                error = abs(target - value)
+                iae += error * step
+                itae += (time - start) * error * step
+                if error > self.band:
+                    settled = time
+                if rising:
+                    overshoot = max(overshoot, value - target)
+                else:
+                    overshoot = max(overshoot, target - value)
+            if abs(target - segment[-1][2]) > self.band:
+                settling_times.append(None)
+            else:
+                settling_times.append(settled - start)
+            overshoots.append(overshoot)
+        return {"settling_times": settling_times, "overshoots": overshoots, "iae": iae, "itae": itae}
+
+
+class _NullWriter(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def simulate(controller, plant, profile=DEFAULT_PROFILE, duration=DEFAULT_DURATION, properties=None, resolution=0.0625, band=0.5, echo=False, inspect=None):
+    # Run a controller's unchanged run() loop against a plant model on a
+    # virtual clock and summarise the closed-loop response. Inspect, if
+    # given, is called with the controller once it has run.
+    actor = Actor()
+    kettle = Kettle(sensor="1", heater="1", target_temp=profile[0][1])
+    metrics = Metrics(band)
+
+    def quantize(value):
+        if resolution:
+            return round(value / resolution) * resolution
+        return value
+
+    cbpi.cache = {
+        "sensors": {1: Sensor(lambda: quantize(plant.outer)), 2: Sensor(lambda: quantize(plant.inner))},
+        "kettle": {1: kettle},
+        "actors": {1: actor}}
+    cbpi.notifications = []
+    clock = SimulationClock(plant, actor, kettle, profile, metrics)
+    cbpi.running = lambda: clock.time() < duration
+
+    kwds = dict(DEFAULT_PROPERTIES.get(controller, {}))
+    kwds.update(properties or {})
+    kwds.update(api=cbpi, kettle_id=1, heater="1", sensor="1")
+    instance = cbpi.controllers[controller](**kwds)
+    instance.clock = clock
+    instance.init()
+
+    stdout = sys.stdout
+    if not echo:
+        sys.stdout = _NullWriter()
+    try:
+        cpu_start = _cpu_time()
+        instance.run()
+        cpu = _cpu_time() - cpu_start
+    finally:
+        sys.stdout = stdout
+    instance.stop()
+    if inspect is not None:
+        inspect(instance)
+
+    result = metrics.summary()
+    result.update({
+        "controller": controller,
+        "switches": actor.switches,
+        "power_changes": actor.power_changes,
+        "cpu_per_hour": cpu / (clock.time() / 3600.0),
+        "notifications": len(cbpi.notifications)})
+    return result
+
+
+def held_gains(controller, plant, autotune, properties=None, echo=False):
+    # Hold the first target of the profile until any autotune experiment is
+    # done, and return the properties of the gains and integrators that the
+    # controller holds it with
+    switch, pids = AUTOTUNE_PROPERTIES[controller]
+    kwds = dict(properties or {})
+    kwds[switch] = "On" if autotune else "Off"
+    held = {}
+
+    def inspect(instance):
+        for name, (kp, ki, kd, integrator) in pids.items():
+            pid = getattr(instance, name)
+            held.update({kp: pid.kp, ki: pid.ki, kd: pid.kd, integrator: pid.integrator})
+    simulate(controller, plant, [DEFAULT_PROFILE[0]], AUTOTUNE_DURATION, kwds, echo=echo, inspect=inspect)
+    return held
+
+
+def autotune_check(controller, plant, properties=None, duration=DEFAULT_DURATION, echo=False):
+    # Compare the mash profile response with the autotuned gains against the
+    # default gains. Both start from the integrators each holds the first
+    # target with, as after an autotune experiment or a restart.
+    results = []
+    for autotune in (False, True):
+        kwds = dict(properties or {})
+        kwds.update(held_gains(controller, plant(), autotune, properties, echo))
+        result = simulate(controller, plant(), duration=duration, properties=kwds, echo=echo)
+        result["controller"] = "%s (%s)" % (controller, "autotuned" if autotune else "default")
+        results.append(result)
+    return results
+
+
+def format_result(result):
+    settling = ", ".join("-" if t is None else "%.0f" % t for t in result["settling_times"])
+    overshoot = ", ".join("%.2f" % o for o in result["overshoots"])
+    return "%-20s settling (s): %-18s overshoot: %-18s IAE: %8.0f  ITAE: %11.0f  switches: %5d  power changes: %5d  CPU/h (s): %.3f" % (
+        result["controller"], settling, overshoot, result["iae"], result["itae"],
+        result["switches"], result["power_changes"], result["cpu_per_hour"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Closed-loop benchmark of the CascadeControl controllers against a simulated kettle")
+    parser.add_argument("--controller", action="append", choices=sorted(DEFAULT_PROPERTIES), help="Controller to benchmark (default: all)")
+    parser.add_argument("--plant", choices=sorted(PLANTS), default="two-node", help="Plant model")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Simulated duration (s)")
+    parser.add_argument("--set", action="append", default=[], metavar="PROPERTY=VALUE", help="Override a controller property")
+    parser.add_argument("--echo", action="store_true", help="Show controller output")
+    parser.add_argument("--autotune-check", action="store_true", help="Check that autotuned gains do no worse (IAE) than the default gains")
+    args = parser.parse_args(argv)
+
+    properties = {}
+    for item in args.set:
+        key, value = item.split("=", 1)
+        properties[key] = value
+
+    if args.autotune_check:
+        worse = []
+        for controller in args.controller or sorted(AUTOTUNE_PROPERTIES):
+            default, autotuned = autotune_check(controller, PLANTS[args.plant], properties, args.duration, args.echo)
+            print(format_result(default))
+            print(format_result(autotuned))
+            if autotuned["iae"] > default["iae"]:
+                worse.append(controller)
+        if worse:
+            print("Autotuned gains do worse than the default gains: %s" % ", ".join(worse))
+            return 1
+        return 0
+
+    for controller in args.controller or sorted(DEFAULT_PROPERTIES):
+        result = simulate(controller, PLANTS[args.plant](), duration=args.duration, properties=properties, echo=args.echo)
+        print(format_result(result))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+
+from .benchmark import plugin
+
+PowerCoordinator = plugin.coordinator.PowerCoordinator
+
+
+def preemption(budget=5000.0, power=3500.0, call_time=200.0, duration=3600.0, update_interval=2.5, on_min=45.0, on_max=1800.0, off_min=90.0):
+    # Two elements share a budget with room for only one of them. A low
+    # priority element is on and calling for power from the start, and a
+    # high priority element starts calling for power at call_time. Return
+    # the time the high priority element switches on (None if it never
+    # does), and the largest power drawn at any time.
+    clock = plugin.clock.VirtualClock()
+    coordinator = PowerCoordinator()
+    low = plugin.Hysteresis(True, on_min, on_max, off_min, clock)
+    high = plugin.Hysteresis(True, on_min, on_max, off_min, clock)
+    coordinator.join(low, power, budget, 0.0)
+    coordinator.join(high, power, budget, 10.0)
+    clock.advance(off_min)
+
+    taken = None
+    peak = 0.0
+    while clock.time() < duration:
+        coordinator.update(low, 60.0, 65.0)
+        coordinator.update(high, 70.0 if clock.time() < call_time else 60.0, 65.0)
+        peak = max(peak, power * (low.on + high.on))
+        if taken is None and high.on:
+            taken = clock.time()
+        clock.advance(update_interval)
+    return taken, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that a higher priority element takes a shared power budget from a lower priority element which is on")
+    parser.add_argument("--budget", type=float, default=5000.0, help="Shared power budget (W)")
+    parser.add_argument("--power", type=float, default=3500.0, help="Element power (W)")
+    parser.add_argument("--call-time", type=float, default=200.0, help="Time the higher priority element starts calling for power (s)")
+    args = parser.parse_args(argv)
+
+    taken, peak = preemption(args.budget, args.power, args.call_time)
+    print("Higher priority element on at (s): %s  peak power (W): %.0f" % ("-" if taken is None else "%.0f" % taken, peak))
+
+    # The lower priority element has long passed its minimum on time, so it
+    # should give way within a few updates
+    failures = []
+    if taken is None or taken > args.call_time + 100.0:
+        failures.append("the higher priority element did not take over")
+    if peak > args.budget:
+        failures.append("the budget was exceeded")
+    if failures:
+        print("Preemption check failed: %s" % ", ".join(failures))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sys
+import types
+
+# A minimal stand-in for the parts of CraftBeerPi 3 used by this plugin, so
+# that the controllers' run() loops can be driven offline without changes.
+
+
+class PropertyType(object):
+    pass
+
+
+class Property(object):
+    # Property definitions, as in CraftBeerPi. A controller attribute keeps
+    # its definition unless a value is given when constructing the
+    # controller, as for a kettle configured before the property was added.
+    class Number(PropertyType):
+        def __init__(self, label, configurable=False, default_value=None, unit="", description=""):
+            self.label = label
+            self.configurable = configurable
+            self.default_value = default_value
+            self.unit = unit
+            self.description = description
+
+    class Text(PropertyType):
+        def __init__(self, label, configurable=False, default_value="", description=""):
+            self.label = label
+            self.configurable = configurable
+            self.default_value = default_value
+            self.description = description
+
+    class Select(PropertyType):
+        def __init__(self, label, options, description=""):
+            self.label = label
+            self.options = options
+            self.description = description
+
+    class Sensor(PropertyType):
+        def __init__(self, label="", description=""):
+            self.label = label
+            self.description = description
+
+    class Actor(PropertyType):
+        def __init__(self, label="", description=""):
+            self.label = label
+            self.description = description
+
+    class Kettle(PropertyType):
+        def __init__(self, label="", description=""):
+            self.label = label
+            self.description = description
+
+
+class Sensor(object):
+    def __init__(self, read):
+        self.read = read
+        self.instance = self
+
+    @property
+    def last_value(self):
+        return self.read()
+
+
+class Kettle(object):
+    def __init__(self, sensor, heater, target_temp):
+        self.sensor = sensor
+        self.heater = heater
+        self.target_temp = target_temp
+
+
+class Actor(object):
+    def __init__(self):
+        self.state = 0
+        self.power = 100
+        self.switches = 0
+        self.power_changes = 0
+
+    @property
+    def output(self):
+        return self.power if self.state else 0.0
+
+    def on(self, power=None):
+        if not self.state:
+            self.switches += 1
+        self.state = 1
+        if power is not None:
+            self.set_power(power)
+
+    def off(self):
+        if self.state:
+            self.switches += 1
+        self.state = 0
+
+    def set_power(self, power):
+        if power != self.power:
+            self.power_changes += 1
+        self.power = power
+
+
+class Cbpi(object):
+    def __init__(self):
+        self.config = {"unit": "C"}
+        self.cache = {"sensors": {}, "kettle": {}, "actors": {}}
+        self.controllers = {}
+        self.initializers = []
+        self.notifications = []
+        self.app = _App()
+        self.app.logger.setLevel(logging.WARNING)
+        self.running = lambda: True
+
+    def controller(self, cls):
+        self.controllers[cls.__name__] = cls
+        return cls
+
+    def initalizer(self, order=0):
+        # Initializers are recorded but not run, as there is no web server
+        def register(function):
+            self.initializers.append((order, function))
+            return function
+        return register
+
+    def get_config_parameter(self, key, default):
+        return self.config.get(key, default)
+
+    def notify(self, headline, message, type="success", timeout=5000):
+        self.notifications.append((headline, message, type))
+
+    def get_sensor_value(self, id):
+        return float(self.cache.get("sensors")[int(id)].instance.last_value)
+
+
+class _App(object):
+    def __init__(self):
+        self.logger = logging.getLogger("cbpi.simulation")
+
+
+class ControllerBase(object):
+    def __init__(self, *args, **kwds):
+        for a in kwds:
+            super(ControllerBase, self).__setattr__(a, kwds.get(a))
+        self.api = kwds.get("api")
+        self.heater_id = kwds.get("heater")
+        self.sensor_id = kwds.get("sensor")
+        self._running = False
+
+    def notify(self, headline, message, type="success", timeout=5000):
+        self.api.notify(headline, message, type, timeout)
+
+    def is_running(self):
+        return self._running and self.api.running()
+
+    def init(self):
+        self._running = True
+
+    def sleep(self, seconds):
+        raise RuntimeError("Simulated controllers must sleep through their clock")
+
+    def stop(self):
+        self._running = False
+
+    def get_sensor_value(self, id=None):
+        return self.api.get_sensor_value(id)
+
+
+class KettleController(ControllerBase):
+    def __init__(self, *args, **kwds):
+        ControllerBase.__init__(self, *args, **kwds)
+        self.kettle_id = kwds.get("kettle_id")
+
+    def _kettle(self):
+        return self.api.cache.get("kettle")[self.kettle_id]
+
+    def _heater(self):
+        return self.api.cache.get("actors")[int(self._kettle().heater)]
+
+    def heater_on(self, power=100):
+        self._heater().on(power)
+
+    def heater_off(self):
+        self._heater().off()
+
+    def actor_power(self, power, id=None):
+        self._heater().set_power(power)
+
+    def get_temp(self, id=None):
+        return self.get_sensor_value(int(self._kettle().sensor))
+
+    def get_target_temp(self, id=None):
+        return self._kettle().target_temp
+
+
+# Single shared instance, as the plugin binds `cbpi` at import time
+cbpi = Cbpi()
+
+
+def install():
+    # Register the stand-in modules under the names the plugin imports
+    modules = types.ModuleType("modules")
+    modules.cbpi = cbpi
+    core = types.ModuleType("modules.core")
+    controller = types.ModuleType("modules.core.controller")
+    controller.KettleController = KettleController
+    props = types.ModuleType("modules.core.props")
+    props.Property = Property
+    modules.core = core
+    core.controller = controller
+    core.props = props
+    sys.modules.update({
+        "modules": modules,
+        "modules.core": core,
+        "modules.core.controller": controller,
+        "modules.core.props": props})
+    return cbpi
+
+
+def load_plugin(path=None, name="cascadecontrol"):
+    # Import the plugin package against the stand-in modules
+    if name in sys.modules:
+        return sys.modules[name]
+    install()
+    if path is None:
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, os.path.join(path, "__init__.py"), submodule_search_locations=[path])
+        module = importlib.util.module_from_spec(spec)
+        # The plugin targets Python 2, where unicode is a builtin
+        module.unicode = str
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+    import imp
+    return imp.load_module(name, None, path, ("", "", imp.PKG_DIRECTORY))
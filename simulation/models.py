@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+# The models below only use plain arithmetic on their states and inputs, so
+# they also step NumPy arrays of states element-wise, which allows many
+# plants to be simulated at once.
+
+
+class FirstOrderDeadTime(object):
+    def __init__(self, gain=0.6, time_constant=900.0, dead_time=30.0, ambient=20.0, initial=None, step=0.5):
+        # First order plus dead time (FOPDT) model of a kettle, where an
+        # output of u % drives the temperature towards ambient + gain * u
+        # with the given time constant, after the given dead time
+        self.gain = gain
+        self.time_constant = time_constant
+        self.ambient = ambient
+        self.step = step
+        if initial is None:
+            initial = ambient
+        self.temperature = initial
+
+        # Inputs are delayed through a buffer holding one entry per step
+        self.delay = deque([0.0] * max(int(round(dead_time / step)), 1))
+
+    @property
+    def inner(self):
+        return self.temperature
+
+    @property
+    def outer(self):
+        return self.temperature
+
+    def advance(self, output, seconds):
+        for _ in range(max(int(round(seconds / self.step)), 1)):
+            self.delay.append(output)
+            delayed_output = self.delay.popleft()
+            self.temperature = self.temperature + self.step * (self.ambient + self.gain * delayed_output - self.temperature) / self.time_constant
+
+
+class TwoNode(object):
+    def __init__(self, power=5500.0, inner_capacity=125000.0, outer_capacity=95000.0, coupling=150.0,
+                 inner_loss=4.0, outer_loss=6.0, dead_time=5.0, ambient=20.0, initial=None, step=0.5):
+        # Two node thermal model of a HERMS or RIMS brewery. The inner node
+        # (element, jacket, HLT or RIMS tube) is heated by the element at u %
+        # of its power and exchanges heat with the outer node (bulk mash
+        # liquid) through the coupling conductance. Both nodes lose heat to
+        # ambient. Capacities are in J/°C, conductances in W/°C.
+        self.power = power
+        self.inner_capacity = inner_capacity
+        self.outer_capacity = outer_capacity
+        self.coupling = coupling
+        self.inner_loss = inner_loss
+        self.outer_loss = outer_loss
+        self.ambient = ambient
+        self.step = step
+        if initial is None:
+            initial = ambient
+        self.inner_temperature = initial
+        self.outer_temperature = initial
+
+        # Inputs are delayed through a buffer holding one entry per step
+        self.delay = deque([0.0] * max(int(round(dead_time / step)), 1))
+
+    @property
+    def inner(self):
+        return self.inner_temperature
+
+    @property
+    def outer(self):
+        return self.outer_temperature
+
+    def advance(self, output, seconds):
+        for _ in range(max(int(round(seconds / self.step)), 1)):
+            self.delay.append(output)
+            delayed_output = self.delay.popleft()
+            transfer = self.coupling * (self.inner_temperature - self.outer_temperature)
+            inner_flow = self.power * delayed_output / 100.0 - transfer - self.inner_loss * (self.inner_temperature - self.ambient)
+            outer_flow = transfer - self.outer_loss * (self.outer_temperature - self.ambient)
+            self.inner_temperature = self.inner_temperature + self.step * inner_flow / self.inner_capacity
+            self.outer_temperature = self.outer_temperature + self.step * outer_flow / self.outer_capacity
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import argparse
+import time
+from importlib import import_module
+
+import numpy as np
+
+from .benchmark import DEFAULT_DURATION, DEFAULT_PROFILE, plugin
+from .models import FirstOrderDeadTime, TwoNode
+
+# The batch engine is not imported by the plugin itself, as it needs NumPy
+BatchPID = import_module(plugin.__name__ + ".batch").BatchPID
+
+PLANTS = {
+    "two-node": TwoNode,
+    "fopdt": FirstOrderDeadTime,
+}
+
+
+def sweep(kp, ki, kd, plant=TwoNode, profile=DEFAULT_PROFILE, duration=DEFAULT_DURATION, update_interval=2.5, maxoutput=100.0, initial=50.0, resolution=0.0625):
+    # Simulate a single loop PID (as in AdvancedPID) on the outer sensor of
+    # one plant per (kp, ki, kd) combination at once, and return the IAE and
+    # the maximum overshoot of each
+    pid = BatchPID(kp, ki, kd, 0.0, maxoutput, 1.0, 0.0)
+    model = plant(initial=np.full(len(pid), initial))
+    iae = np.zeros(len(pid))
+    overshoot = np.zeros(len(pid))
+    elapsed = 0.0
+    while elapsed < duration:
+        target = [t for step_time, t in profile if step_time <= elapsed][-1]
+        current = model.outer
+        if resolution:
+            current = np.round(current / resolution) * resolution
+        output = pid.update(current, target, update_interval)
+        model.advance(output, update_interval)
+        elapsed += update_interval
+        iae += np.abs(target - model.outer) * update_interval
+        overshoot = np.maximum(overshoot, model.outer - target)
+    return iae, overshoot
+
+
+def grid(kp_values, ki_values, kd_values):
+    # All combinations of the given gains as flat arrays
+    kp, ki, kd = np.meshgrid(kp_values, ki_values, kd_values, indexing="ij")
+    return kp.ravel(), ki.ravel(), kd.ravel()
+
+
+def _span(text):
+    # Parse start:stop:count into evenly spaced values
+    start, stop, count = text.split(":")
+    return np.linspace(float(start), float(stop), int(count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep PID gains against a simulated kettle")
+    parser.add_argument("--kp", type=_span, default=_span("1:40:25"), help="start:stop:count")
+    parser.add_argument("--ki", type=_span, default=_span("0:0.5:20"), help="start:stop:count")
+    parser.add_argument("--kd", type=_span, default=_span("0:20:20"), help="start:stop:count")
+    parser.add_argument("--plant", choices=sorted(PLANTS), default="two-node", help="Plant model")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Simulated duration (s)")
+    parser.add_argument("--top", type=int, default=10, help="Number of best gain sets to show")
+    args = parser.parse_args(argv)
+
+    kp, ki, kd = grid(args.kp, args.ki, args.kd)
+    start = time.time()
+    iae, overshoot = sweep(kp, ki, kd, plant=PLANTS[args.plant], duration=args.duration)
+    print("Simulated %d gain sets in %.1f s" % (len(kp), time.time() - start))
+    for i in np.argsort(iae)[:args.top]:
+        print("kp: %6.2f  ki: %6.3f  kd: %6.2f  IAE: %8.0f  overshoot: %5.2f" % (kp[i], ki[i], kd[i], iae[i], overshoot[i]))
+
+
+if __name__ == "__main__":
+    main()
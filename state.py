@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from .clock import MonotonicClock
+
+
+def state_path(kettle_id):
+    return os.path.join("logs", "cascadecontrol_kettle_%s.state" % kettle_id)
+
+
+class StateStore(object):
+    def __init__(self, path, interval=60.0, clock=None):
+        # Persists snapshots of a kettle's controller state, so that a
+        # controller restarted on the same kettle, or another controller
+        # taking it over, can resume where the last one left off. Snapshots
+        # are small JSON documents, written at most once per interval by
+        # replacing the file, so that a crash never leaves a partial file.
+        self.path = path
+        self.interval = interval
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+        self.last_save = None
+
+    def load(self, max_age):
+        # The last snapshot, with its age in seconds added, or None if there
+        # is none, it cannot be read, or it is older than max_age
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            snapshot["age"] = self.clock.wall() - snapshot["time"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if not 0.0 <= snapshot["age"] <= max_age:
+            return None
+        return snapshot
+
+    def due(self):
+        return self.last_save is None or self.clock.time() - self.last_save >= self.interval
+
+    def save(self, snapshot):
+        snapshot["time"] = self.clock.wall()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(snapshot, f)
+        os.rename(temporary, self.path)
+        self.last_save = self.clock.time()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import array
+import os
+import sys
+import threading
+
+# Fields of each telemetry record. Loops are numbered 0 for the outer (or
+# only) loop and 1 for the inner loop of a cascade.
+FIELDS = ("time", "loop", "target", "actual", "output", "integrator", "p", "i", "d")
+WIDTH = len(FIELDS)
+
+PID_FORMAT = "[%s] %s target/actual/output/integrator: %s/%s/%s/%s"
+HYSTERESIS_FORMAT = "[%s] %s target/actual/output: %s/%s/%s"
+
+# Minimum time in seconds between log lines of a loop for each logging option
+LOG_PERIODS = {"Every cycle": 0.0, "Every minute": 60.0, "Off": 0.0}
+
+
+class TelemetryBuffer(object):
+    def __init__(self, capacity=1024):
+        # Fixed size ring buffer of numeric records, preallocated so that
+        # pushing a record neither allocates nor formats anything. When full,
+        # the oldest records are overwritten.
+        self.capacity = capacity
+        self.data = array.array("d", [0.0]) * (capacity * WIDTH)
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+        # Set when the buffer is half full, to wake a writer early
+        self.half_full = threading.Event()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, time, loop, target, actual, output, integrator=0.0, p=0.0, i=0.0, d=0.0):
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                self.tail += 1
+                self.dropped += 1
+            offset = (self.head % self.capacity) * WIDTH
+            data = self.data
+            data[offset] = time
+            data[offset + 1] = loop
+            data[offset + 2] = target
+            data[offset + 3] = actual
+            data[offset + 4] = output
+            data[offset + 5] = integrator
+            data[offset + 6] = p
+            data[offset + 7] = i
+            data[offset + 8] = d
+            self.head += 1
+            if self.head - self.tail == self.capacity // 2:
+                self.half_full.set()
+
+    def drain(self):
+        # Remove and return all buffered records as a flat array, oldest first
+        with self.lock:
+            start = (self.tail % self.capacity) * WIDTH
+            end = (self.head % self.capacity) * WIDTH
+            if self.head == self.tail:
+                records = array.array("d")
+            elif start < end:
+                records = self.data[start:end]
+            else:
+                records = self.data[start:] + self.data[:end]
+            self.tail = self.head
+            self.half_full.clear()
+        return records
+
+
+class TelemetryWriter(object):
+    def __init__(self, buffer, labels, logger=None, log_period=0.0, echo=False, path=None, binary=False, recorder=None, interval=5.0):
+        # Drains a telemetry buffer from a background thread, so that the
+        # control loop does no formatting or I/O. Labels map loop numbers to
+        # (name, is_pid) for log lines, which are only formatted when emitted:
+        # at most one line per loop per log_period, or none without a logger.
+        self.buffer = buffer
+        self.labels = labels
+        self.logger = logger
+        self.log_period = log_period
+        self.echo = echo
+        self.last_logged = {}
+
+        # Records are optionally appended in batches to a CSV file, or to a
+        # binary file of native doubles with FIELDS in each record
+        self.path = path
+        self.binary = binary
+
+        # Records are also optionally appended to a Recorder
+        self.recorder = recorder
+        self.interval = interval
+
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.buffer.half_full.set()
+        self.thread.join()
+
+    def run(self):
+        # Flush every interval, or early when the buffer is half full
+        while not self.stopping:
+            self.buffer.half_full.wait(self.interval)
+            self.flush()
+        self.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def flush(self):
+        records = self.buffer.drain()
+        if not records:
+            return
+        if self.logger is not None or self.echo:
+            self.emit(records)
+        if self.path is not None:
+            self.write(records)
+        if self.recorder is not None:
+            self.recorder.append(records)
+
+    def emit(self, records):
+        for offset in range(0, len(records), WIDTH):
+            time, loop = records[offset], int(records[offset + 1])
+            if time - self.last_logged.get(loop, float("-inf")) < self.log_period:
+                continue
+            self.last_logged[loop] = time
+            name, pid = self.labels[loop]
+            target, actual, output, integrator = records[offset + 2:offset + 6]
+            if pid:
+                args = (time, name, target, actual, output, round(integrator, 2))
+                fmt = PID_FORMAT
+            else:
+                args = (time, name, target, actual, output)
+                fmt = HYSTERESIS_FORMAT
+            if self.logger is not None:
+                self.logger.info(fmt, *args)
+            if self.echo:
+                sys.stdout.write((fmt % args) + "\n")
+
+    def write(self, records):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.binary:
+            with open(self.path, "ab") as f:
+                records.tofile(f)
+        else:
+            new = not os.path.exists(self.path)
+            with open(self.path, "a") as f:
+                if new:
+                    f.write(",".join(FIELDS) + "\n")
+                for offset in range(0, len(records), WIDTH):
+                    f.write(",".join(repr(value) for value in records[offset:offset + WIDTH]) + "\n")
+
+
+def telemetry_path(kettle_id, file_type):
+    # Path of a kettle's telemetry file, or None when the file is off
+    if file_type == "CSV":
+        return os.path.join("logs", "cascadecontrol_kettle_%s.csv" % kettle_id)
+    elif file_type == "Binary":
+        return os.path.join("logs", "cascadecontrol_kettle_%s.bin" % kettle_id)
+    return None
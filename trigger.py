@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from .clock import MonotonicClock
+
+
+class SampleTrigger(object):
+    def __init__(self, sources, min_interval, watchdog, poll=0.25, clock=None):
+        # Wakes a control loop when any of its sensors delivers a new sample,
+        # instead of at a fixed interval. Sources are callables returning the
+        # latest value of each sensor, which are cheap to poll.
+        self.sources = sources
+
+        # Limit the update rate to at most once per min_interval, and update
+        # at least once per watchdog period even if no new samples arrive
+        # (e.g. when a sensor repeats the same value)
+        self.min_interval = min_interval
+        self.watchdog = max(watchdog, min_interval)
+        self.poll = poll
+
+        if clock is None:
+            clock = MonotonicClock()
+        self.clock = clock
+
+        self.last_trigger = self.clock.time()
+        self.last_values = self.sample()
+
+        # Count wake ups for each reason
+        self.samples = 0
+        self.timeouts = 0
+
+    def sample(self):
+        return [source() for source in self.sources]
+
+    def wait(self):
+        # Sleep until the loop should update again, returning True if woken by
+        # a new sample, or False if woken by the watchdog
+        # Re-anchor if the clock has stepped backward, as a wall clock
+        # fallback may
+        if self.clock.time() < self.last_trigger:
+            self.last_trigger = self.clock.time()
+        earliest = self.last_trigger + self.min_interval
+        deadline = self.last_trigger + self.watchdog
+        self.clock.sleep(earliest - self.clock.time())
+        while True:
+            values = self.sample()
+            now = self.clock.time()
+            if values != self.last_values:
+                self.samples += 1
+                triggered = True
+                break
+            if now >= deadline:
+                self.timeouts += 1
+                triggered = False
+                break
+            self.clock.sleep(min(self.poll, deadline - now))
+        self.last_values = values
+        self.last_trigger = now
+        return triggered